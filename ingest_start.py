@@ -0,0 +1,42 @@
+from seraphsix.constants import LOG_FORMAT_MSG, LOG_FORMAT_TIME
+from seraphsix.tasks.config import Config
+from seraphsix.worker import IngestWorker
+
+import asyncio
+import logging
+import signal
+import warnings
+
+warnings.filterwarnings('ignore', category=UserWarning, module='psycopg2')
+
+
+def main():
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter(fmt=LOG_FORMAT_MSG, datefmt=LOG_FORMAT_TIME)
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    logging.getLogger('aiohttp.client').setLevel(logging.ERROR)
+    logging.getLogger('aioredis').setLevel(logging.DEBUG)
+    logging.getLogger('backoff').setLevel(logging.DEBUG)
+
+    config = Config()
+    worker = IngestWorker(config)
+
+    loop = asyncio.get_event_loop()
+    run = loop.create_task(worker.run())
+    # Heroku stops dynos with SIGTERM, either signal lets the worker flush and close cleanly
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, run.cancel)
+    try:
+        loop.run_until_complete(run)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        loop.run_until_complete(worker.close())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+from seraphsix.archive import PgcrArchive
+from seraphsix.constants import LOG_FORMAT_MSG, LOG_FORMAT_TIME
+from seraphsix.database import Database
+from seraphsix.tasks.activity import replay_pgcr_archive
+from seraphsix.tasks.config import Config
+from seraphsix.tasks.parsing import PgcrParser
+
+import argparse
+import asyncio
+import logging
+import sys
+import warnings
+
+warnings.filterwarnings('ignore', category=UserWarning, module='psycopg2')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild stored games from the PGCR archive without calling Bungie")
+    parser.add_argument(
+        '--rebuild', action='store_true',
+        help="re-create every archived game for tracked clans and their members instead of only adding missing ones")
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter(fmt=LOG_FORMAT_MSG, datefmt=LOG_FORMAT_TIME)
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    config = Config()
+    if not config.pgcr_archive_path:
+        logger.error("PGCR_ARCHIVE_PATH is not set")
+        sys.exit(1)
+
+    database = Database(config.database_url)
+    database.initialize()
+    archive = PgcrArchive(config.pgcr_archive_path)
+    pgcr_parser = PgcrParser(config.pgcr_workers)
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(
+            replay_pgcr_archive(database, archive, config.activity_cutoff, rebuild=args.rebuild, parser=pgcr_parser))
+    finally:
+        loop.run_until_complete(database.close())
+        archive.close()
+        pgcr_parser.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from seraphsix import constants
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.bin'
+LOCK_FILE = 'archive.lock'
+SEGMENT_FILE = 'segment-{:05d}.dat'
+
+# instance_id, segment number, offset in segment, compressed length
+INDEX_RECORD = struct.Struct('<QHQI')
+
+
+def compress_pgcr(pgcr):
+    """A PGCR as the archive stores it, picklable so it can run in a worker process"""
+    return zlib.compress(json.dumps(pgcr, separators=(',', ':')).encode('utf-8'))
+
+
+class PgcrArchive(object):
+    """Append-only store of compressed raw PGCRs, split into segment files with a fixed width index"""
+
+    def __init__(self, path, segment_size=constants.PGCR_ARCHIVE_SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok=True)
+
+        self._index = {}
+        self._index_offset = 0
+        self._segment = 0
+        self._maps = {}
+        # Reads and writes happen in executor threads, which must not refresh the index or
+        # remap segments at the same time
+        self._lock = threading.RLock()
+        self._refresh()
+        log.info(f"Opened PGCR archive at {path} with {len(self._index)} entries")
+
+    def __contains__(self, instance_id):
+        return instance_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        for instance_id in list(self._index.keys()):
+            pgcr = self.get(instance_id)
+            if pgcr:
+                yield instance_id, pgcr
+
+    def instance_ids(self):
+        with self._lock:
+            self._refresh()
+            return list(self._index.keys())
+
+    def _file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _segment_path(self, segment):
+        return self._file_path(SEGMENT_FILE.format(segment))
+
+    def _refresh(self):
+        # Pick up any entries appended since the last read, possibly by another process
+        try:
+            with open(self._file_path(INDEX_FILE), 'rb') as index_file:
+                index_file.seek(self._index_offset)
+                data = index_file.read()
+        except FileNotFoundError:
+            return
+
+        # Ignore a trailing partial record, it will be read once it is complete
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        for instance_id, segment, offset, length in INDEX_RECORD.iter_unpack(data[:usable]):
+            self._index[instance_id] = (segment, offset, length)
+            self._segment = max(self._segment, segment)
+        self._index_offset += usable
+
+    def _map(self, segment, size):
+        segment_map = self._maps.get(segment)
+        if segment_map is None or len(segment_map) < size:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self._segment_path(segment), 'rb') as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        return segment_map
+
+    def get_raw(self, instance_id):
+        """The PGCR as stored, zlib compressed JSON"""
+        with self._lock:
+            try:
+                segment, offset, length = self._index[instance_id]
+            except KeyError:
+                self._refresh()
+                try:
+                    segment, offset, length = self._index[instance_id]
+                except KeyError:
+                    return None
+
+            segment_map = self._map(segment, offset + length)
+            return segment_map[offset:offset + length]
+
+    def get(self, instance_id):
+        data = self.get_raw(instance_id)
+        if data is None:
+            return None
+        return json.loads(zlib.decompress(data))
+
+    def add(self, instance_id, pgcr):
+        if instance_id in self._index:
+            return False
+        return self.add_raw(instance_id, compress_pgcr(pgcr))
+
+    def add_raw(self, instance_id, data):
+        """Add a PGCR that was already compressed"""
+        if instance_id in self._index:
+            return False
+
+        with self._lock, open(self._file_path(LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh()
+            if instance_id in self._index:
+                return False
+
+            try:
+                offset = os.path.getsize(self._segment_path(self._segment))
+            except FileNotFoundError:
+                offset = 0
+
+            if offset and offset + len(data) > self.segment_size:
+                self._segment += 1
+                offset = 0
+
+            # The payload is written before its index record, so a crash in between
+            # leaves an unreferenced payload rather than a dangling index entry
+            with open(self._segment_path(self._segment), 'ab') as segment_file:
+                segment_file.write(data)
+            with open(self._file_path(INDEX_FILE), 'ab') as index_file:
+                index_file.write(INDEX_RECORD.pack(instance_id, self._segment, offset, len(data)))
+
+            self._index[instance_id] = (self._segment, offset, len(data))
+            self._index_offset += INDEX_RECORD.size
+        return True
+
+    def close(self):
+        for segment_map in self._maps.values():
+            segment_map.close()
+        self._maps = {}
@@ -1,5 +1,4 @@
 #!/usr/bin/env python3.7
-import aioredis
 import asyncio
 import discord
 import io
@@ -10,17 +9,19 @@ import traceback
 from discord.ext import commands, tasks
 from peewee import DoesNotExist
 from peony import PeonyClient
-from pydest import Pydest
 from the100 import The100
 
 from seraphsix import constants
 from seraphsix.cogs.utils.message_manager import MessageManager
-from seraphsix.database import Database, Guild, TwitterChannel
+from seraphsix.database import Guild, TwitterChannel
+from seraphsix.manifest import ManifestStore
+from seraphsix.pipeline import ActivityPipeline
 
 from seraphsix.errors import (
     InvalidCommandError, InvalidGameModeError, InvalidMemberError,
     NotRegisteredError, ConfigurationError, MissingTimezoneError, MaintenanceError)
-from seraphsix.tasks.activity import store_all_games, store_last_active
+from seraphsix.tasks.activity import (
+    get_job_handlers, run_activity_sweep, store_all_guild_games, store_all_last_active, update_manifest)
 from seraphsix.tasks.discord import store_sherpas, update_sherpa
 
 log = logging.getLogger(__name__)
@@ -37,17 +38,11 @@ async def _prefix_callable(bot, message):
     if isinstance(message.channel, discord.abc.PrivateChannel):
         base.append('?')
     else:
-        try:
-            guild = await bot.database.get(Guild, guild_id=message.guild.id)
-        except DoesNotExist:
-            await bot.database.create(Guild, guild_id=message.guild.id)
-            base.append('?')
-        else:
-            base.append(guild.prefix)
+        base.append(await bot.get_guild_prefix(message.guild.id))
     return base
 
 
-class SeraphSix(commands.Bot):
+class SeraphSix(ActivityPipeline, commands.Bot):
 
     def __init__(self, config):
         super().__init__(
@@ -56,18 +51,12 @@ class SeraphSix(commands.Bot):
                 no_category="Assorted", dm_help=True, verify_checks=False)
         )
 
-        self.config = config
-        self.database = Database(config.database_url)
-        self.database.initialize()
-
-        self.destiny = Pydest(
-            api_key=config.bungie.api_key,
-            client_id=config.bungie.client_id,
-            client_secret=config.bungie.client_secret,
-        )
+        self.setup_pipeline(config)
 
         self.the100 = The100(config.the100.api_key, config.the100.base_url)
 
+        self.manifest = ManifestStore(config.manifest_path)
+
         self.twitter = None
         if (config.twitter.consumer_key and config.twitter.consumer_secret and
                 config.twitter.access_token and config.twitter.access_token_secret):
@@ -80,48 +69,32 @@ class SeraphSix(commands.Bot):
                 exc = traceback.format_exception(type(e), e, e.__traceback__)
                 log.error(f"Failed to load extension {extension}: {exc}")
 
-        self.bungie_maintenance = False
+        self.guild_prefixes = {}
+        self.job_consumer = None
 
+        self.update_destiny_manifest.start()
         if config.enable_activity_tracking:
             self.update_last_active.start()
             self.update_member_games.start()
 
-    @tasks.loop(minutes=5.0)
-    async def update_last_active(self):
-        tasks = []
-        guilds = await self.database.execute(Guild.select())
-        if not guilds:
-            return
-        for guild in guilds:
-            guild_id = guild.guild_id
-            discord_guild = await self.fetch_guild(guild.guild_id)
-            log.info(f"Finding last active dates for all members of {str(discord_guild)} ({guild_id})")
-
-            if not hasattr(self, 'redis'):
-                await self.connect_redis()
-
-            try:
-                tasks.extend([
-                    store_last_active(self, member)
-                    for member in await self.database.get_clan_members_by_guild_id(guild_id)
-                ])
-            except AttributeError:
-                log.exception("Redis connection not found")
-                await self.log_channel.send("Redis connection not found")
-                break
-
+    @tasks.loop(hours=24.0)
+    async def update_destiny_manifest(self):
+        if not hasattr(self, 'redis'):
+            await self.connect_redis()
         try:
-            await asyncio.gather(*tasks)
-        except MaintenanceError as e:
-            if not self.bungie_maintenance:
-                log.info(f"Bungie maintenance is ongoing: {e}")
-                self.bungie_maintenance = True
-        else:
-            if self.bungie_maintenance:
-                self.bungie_maintenance = False
-                log.info("Bungie maintenance has ended")
+            await update_manifest(self.destiny, self.redis, self.manifest)
+        except Exception:
+            log.exception("Failed to update the manifest")
 
-        log.info("Found last active dates in all guilds")
+    @update_destiny_manifest.before_loop
+    async def before_update_destiny_manifest(self):
+        await self.wait_until_ready()
+
+    @tasks.loop(minutes=5.0)
+    async def update_last_active(self):
+        if not hasattr(self, 'redis'):
+            await self.connect_redis()
+        await run_activity_sweep(self, store_all_last_active)
 
     @update_last_active.before_loop
     async def before_update_last_active(self):
@@ -130,22 +103,7 @@ class SeraphSix(commands.Bot):
     @tasks.loop(hours=1.0)
     async def update_member_games(self):
         await asyncio.sleep(constants.TIME_MIN_SECONDS)
-
-        guilds = await self.database.execute(Guild.select())
-        if not guilds:
-            return
-
-        tasks = [store_all_games(self, guild.guild_id) for guild in guilds]
-        try:
-            await asyncio.gather(*tasks)
-        except MaintenanceError as e:
-            if not self.bungie_maintenance:
-                log.info(f"Bungie maintenance is ongoing: {e}")
-                self.bungie_maintenance = True
-        else:
-            if self.bungie_maintenance:
-                self.bungie_maintenance = False
-                log.info("Bungie maintenance has ended")
+        await run_activity_sweep(self, store_all_guild_games)
 
     @update_member_games.before_loop
     async def before_update_member_games(self):
@@ -187,11 +145,39 @@ class SeraphSix(commands.Bot):
                     continue
                 self.loop.create_task(self.process_tweet(tweet))
 
-    async def connect_redis(self):
-        self.redis = await aioredis.create_redis_pool(self.config.redis_url)
+    async def load_guild_prefixes(self):
+        guilds = await self.database.execute(Guild.select())
+        self.guild_prefixes = {guild.guild_id: guild.prefix for guild in guilds}
+        log.info(f"Cached command prefixes for {len(self.guild_prefixes)} guilds")
+
+    async def get_guild_prefix(self, guild_id):
+        try:
+            return self.guild_prefixes[guild_id]
+        except KeyError:
+            pass
+
+        try:
+            guild = await self.database.get(Guild, guild_id=guild_id)
+        except DoesNotExist:
+            await self.database.create(Guild, guild_id=guild_id)
+            prefix = '?'
+        else:
+            prefix = guild.prefix
+        self.guild_prefixes[guild_id] = prefix
+        return prefix
+
+    def invalidate_guild_prefix(self, guild_id):
+        self.guild_prefixes.pop(guild_id, None)
+
+    async def start(self, *args, **kwargs):
+        # Discord keeps its own connections, discord.py closes its connector on logout
+        await self.attach_transport()
+        await self.transport.attach(self.the100, 'session')
+        await super().start(*args, **kwargs)
 
     async def on_ready(self):
         await self.connect_redis()
+        await self.load_guild_prefixes()
 
         self.log_channel = self.get_channel(self.config.log_channel)
         self.reg_channel = self.get_channel(self.config.reg_channel)
@@ -203,6 +189,12 @@ class SeraphSix(commands.Bot):
         log.info(start_message)
         await self.log_channel.send("Seraph Six has started...")
 
+        # With activity tracking disabled here, a separate ingestion worker is
+        # expected to be running and consuming jobs instead
+        if self.config.enable_activity_tracking and not self.job_consumer:
+            self.job_consumer = self.loop.create_task(
+                self.jobs.consume(get_job_handlers(self), self.config.job_concurrency))
+
         if self.twitter:
             log.info("Starting Twitter stream tracking")
             self.loop.create_task(self.track_tweets())
@@ -217,6 +209,7 @@ class SeraphSix(commands.Bot):
         await self.log_channel.send(f"Seraph Six joined {guild.name} (id:{guild.id})!")
 
     async def on_guild_remove(self, guild):
+        self.invalidate_guild_prefix(guild.id)
         await self.log_channel.send(f"Seraph Six left {guild.name} (id:{guild.id})...")
 
     async def on_command_error(self, ctx, error):
@@ -269,15 +262,26 @@ class SeraphSix(commands.Bot):
     #     await self.change_presence(activity=status)
 
     async def on_message(self, message):
-        if not message.author.bot:
-            ctx = await self.get_context(message)
-            await self.invoke(ctx)
+        if message.author.bot:
+            return
+
+        # Plain chat is by far the most common message, so bail out before building
+        # a context unless the message starts with one of the (cached) prefixes
+        prefixes = await self.get_prefix(message)
+        if isinstance(prefixes, str):
+            prefixes = [prefixes]
+        if not message.content.startswith(tuple(prefix for prefix in prefixes if prefix)):
+            return
+
+        ctx = await self.get_context(message)
+        await self.invoke(ctx)
 
     async def close(self):
         await self.log_channel.send("Seraph Six is shutting down...")
-        await self.destiny.close()
-        await self.database.close()
-        await self.the100.close()
+        if self.job_consumer:
+            self.job_consumer.cancel()
+        await self.close_pipeline(self.the100)
+        self.manifest.close()
         if self.twitter:
             await self.twitter.close()
         await super().close()
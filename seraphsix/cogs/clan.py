@@ -235,7 +235,8 @@ class ClanCog(commands.Cog, name="Clan"):
             embeds = pickle.loads(clan_info_redis)
         else:
             for clan_db in clan_dbs:
-                res = await execute_pydest(self.bot.destiny.api.get_group(clan_db.clan_id), self.bot.redis)
+                res = await execute_pydest(
+                    self.bot.destiny.api.get_group(clan_db.clan_id), self.bot.redis, cache='-nocache' not in args)
                 group = res['Response']
                 embed = discord.Embed(
                     colour=constants.BLUE,
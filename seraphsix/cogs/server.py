@@ -138,6 +138,7 @@ class ServerCog(commands.Cog, name="Server"):
             guild_db = await self.bot.database.get(Guild, guild_id=ctx.guild.id)
             guild_db.prefix = new_prefix
             await self.bot.database.update(guild_db)
+            self.bot.invalidate_guild_prefix(ctx.guild.id)
             message = f"Command prefix has been changed to `{new_prefix}`"
 
         return await manager.send_and_clean(message)
@@ -2,6 +2,7 @@ import pytz
 
 from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 from seraphsix.constants import BUNGIE_DATE_FORMAT
 
 
@@ -32,8 +33,20 @@ def sort_dict(d):
     return res
 
 
+@lru_cache(maxsize=8192)
 def bungie_date_as_utc(date):
-    return datetime.strptime(date, BUNGIE_DATE_FORMAT).astimezone(tz=pytz.utc)
+    # Bungie dates are always like 2019-10-01T18:00:00Z, picking the fields out by
+    # position is much faster than strptime. Anything else still goes through strptime.
+    if len(date) == 20 and date[10] == 'T' and date[19] == 'Z':
+        return datetime(
+            int(date[0:4]), int(date[5:7]), int(date[8:10]),
+            int(date[11:13]), int(date[14:16]), int(date[17:19]), tzinfo=pytz.utc
+        )
+    parsed = datetime.strptime(date, BUNGIE_DATE_FORMAT)
+    if parsed.tzinfo is None:
+        # Like the fast path, a date without an offset is in UTC rather than local time
+        return parsed.replace(tzinfo=pytz.utc)
+    return parsed.astimezone(tz=pytz.utc)
 
 
 def get_timezone_name(timezone, country_code):
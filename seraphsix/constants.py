@@ -13,6 +13,91 @@ CLEANUP_DELAY = 4
 TIME_HOUR_SECONDS = 3600
 TIME_MIN_SECONDS = 60
 
+# Requests per second across all processes, and optional tighter limits for
+# individual API endpoints as a (requests per second, burst capacity) pair
+BUNGIE_RATE_LIMIT = 25
+BUNGIE_ENDPOINT_RATE_LIMITS = {}
+
+# Seconds Bungie API responses are cached for, only these endpoints are cached
+BUNGIE_CACHE_TTLS = {
+    'get_group': 15 * TIME_MIN_SECONDS,
+    'get_group_members': TIME_MIN_SECONDS,
+    'get_membership_data_by_id': TIME_HOUR_SECONDS,
+    'search_destiny_player': TIME_HOUR_SECONDS,
+}
+
+# Public read only endpoints, identical calls to these made at the same time share one request
+BUNGIE_SINGLE_FLIGHT_ENDPOINTS = {
+    'get_activity_history',
+    'get_destiny_manifest',
+    'get_group',
+    'get_group_members',
+    'get_membership_data_by_id',
+    'get_post_game_carnage_report',
+    'get_profile',
+    'search_destiny_player',
+}
+
+# Bungie API call priorities, from commands run by users down to hourly sweeps,
+# and the number of tokens each one must leave in the global bucket
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SYNC = 1
+PRIORITY_BACKGROUND = 2
+
+BUNGIE_PRIORITY_RESERVES = {
+    PRIORITY_INTERACTIVE: 0,
+    PRIORITY_SYNC: 5,
+    PRIORITY_BACKGROUND: 10,
+}
+
+# How the last active sweep works out when members last played, either from every
+# member's profile, from clan rosters with profiles only for members whose status
+# changed, or from profiles checked on a schedule depending on how recently they played
+LAST_ACTIVE_PROFILE = 'profile'
+LAST_ACTIVE_PRESENCE = 'presence'
+LAST_ACTIVE_SCHEDULED = 'scheduled'
+
+# Tiers used by the scheduled last active mode, as (tier, played within, check interval)
+# in seconds. Members online now are always hot, the last tier catches everyone else.
+ACTIVITY_TIERS = [
+    ('hot', TIME_HOUR_SECONDS, 5 * TIME_MIN_SECONDS),
+    ('warm', 24 * TIME_HOUR_SECONDS, TIME_HOUR_SECONDS),
+    ('cold', None, 12 * TIME_HOUR_SECONDS),
+]
+
+# Durable job queue for member history scans, all times are in seconds
+JOB_STREAM = 'jobs'
+JOB_POLL_TIMEOUT = 5
+JOB_VISIBILITY_TIMEOUT = 30 * TIME_MIN_SECONDS
+JOB_CHECKPOINT_EXPIRE = 7 * 24 * TIME_HOUR_SECONDS
+JOB_QUEUED_EXPIRE = 24 * TIME_HOUR_SECONDS
+JOB_RETRY_DELAY = TIME_MIN_SECONDS
+JOB_ERROR_DELAY = 10
+
+# How long a process can hold on to a game it is storing before others may try, in seconds
+GAME_CLAIM_TTL = 10 * TIME_MIN_SECONDS
+
+# Games older than the retention period are forgotten and looked up in the database again
+# if they ever come up, the local copy is reloaded from Redis every refresh, in seconds
+INSTANCE_FILTER_RETENTION = 30 * 24 * TIME_HOUR_SECONDS
+INSTANCE_FILTER_REFRESH = 15 * TIME_MIN_SECONDS
+
+PGCR_ARCHIVE_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# Carnage reports are fetched without decoding them and handed to the parser in batches
+PGCR_BATCH_SIZE = 50
+PGCR_URL = 'https://www.bungie.net/Platform/Destiny2/Stats/PostGameCarnageReport/'
+
+# Error code of Bungie API responses while it is down for maintenance
+BUNGIE_ERROR_SYSTEM_DISABLED = 5
+
+# Manifest definitions kept in the local store, how many decoded ones to keep in memory
+# and how long downloading one may take, in seconds
+BUNGIE_BASE_URL = 'https://www.bungie.net'
+MANIFEST_DEFINITIONS = ['DestinyActivityDefinition', 'DestinyActivityModeDefinition']
+MANIFEST_CACHE_SIZE = 4096
+MANIFEST_DOWNLOAD_TIMEOUT = 10 * TIME_MIN_SECONDS
+
 EMOJI_PC = 586933311994200074
 EMOJI_PSN = 590019204623761438
 EMOJI_XBOX = 590004787370786817
@@ -7,7 +7,7 @@ from datetime import datetime, timedelta
 from peewee import (
     Model, CharField, BigIntegerField, IntegerField, FloatField,
     ForeignKeyField, Proxy, BooleanField, Check, SQL, fn, Case,
-    InterfaceError, OperationalError, JOIN)
+    InterfaceError, OperationalError, JOIN, EXCLUDED, Cast, ValuesList)
 from peewee_async import Manager
 from peewee_asyncext import PooledPostgresqlExtDatabase
 from playhouse.postgres_ext import DateTimeTZField
@@ -220,12 +220,45 @@ class Database(object):
         return await self._objects.count(query, clear_limit)
 
     async def bulk_update(self, model_list, fields, batch_size=None):
+        model_list = list(model_list)
+        if not model_list:
+            return 0
+
+        # Each batch is a single UPDATE ... FROM (VALUES ...) joined on the primary key. The
+        # values are cast to the column types since Postgres can't infer a type from NULLs.
         model = type(model_list[0])
-        query = model.bulk_update(model_list, fields=fields, batch_size=batch_size)
-        try:
-            return await self.execute(query)
-        except AttributeError:
-            return False
+        primary_key = model._meta.primary_key
+        fields = [model._meta.fields[field] if isinstance(field, str) else field for field in fields]
+        context = self._database.get_sql_context()
+        columns = [primary_key.column_name] + [field.column_name for field in fields]
+
+        updated = 0
+        batch_size = batch_size or len(model_list)
+        for start in range(0, len(model_list), batch_size):
+            rows = [
+                [instance.get_id()] + [field.db_value(instance.__data__.get(field.name)) for field in fields]
+                for instance in model_list[start:start + batch_size]
+            ]
+            values = ValuesList(rows, columns=columns, alias='batch')
+            query = model.update({
+                field: Cast(getattr(values.c, field.column_name), field.ddl_datatype(context).sql)
+                for field in fields
+            }).from_(values).where(primary_key == getattr(values.c, primary_key.column_name))
+            count = await self.execute(query)
+            if count is None:
+                return False
+            updated += count
+        return updated
+
+    async def upsert_game_members(self, game_members):
+        query = GameMember.insert_many(game_members).on_conflict(
+            conflict_target=[GameMember.member, GameMember.game],
+            update={
+                GameMember.time_played: fn.COALESCE(GameMember.time_played, 0) + EXCLUDED.time_played,
+                GameMember.completed: fn.COALESCE(GameMember.completed, False) | EXCLUDED.completed
+            }
+        )
+        return await self.execute(query)
 
     async def get_member_by_platform(self, member_id, platform_id):
         # pylint: disable=assignment-from-no-return
@@ -307,7 +340,7 @@ class Database(object):
                 Guild.guild_id == guild_id,
             ).dicts()
         else:
-            query = Member.select(Member, ClanMember).join(ClanMember).join(Clan).join(Guild).where(
+            query = Member.select(Member, ClanMember, Clan).join(ClanMember).join(Clan).join(Guild).where(
                 Guild.guild_id == guild_id,
             )
         return await self.execute(query)
@@ -340,6 +373,13 @@ class Database(object):
             )
         return await self.get(query)
 
+    async def get_clan_member_by_member_id(self, member_id, clan_id):
+        query = Member.select(Member, ClanMember).join(ClanMember).join(Clan).where(
+            Member.id == member_id,
+            Clan.clan_id == clan_id
+        )
+        return await self.get(query)
+
     async def get_clans_by_guild(self, guild_id):
         query = Clan.select().join(Guild).where(
             Guild.guild_id == guild_id
@@ -355,5 +395,51 @@ class Database(object):
         )
         return await self.execute(query)
 
+    async def get_existing_instance_ids(self, instance_ids):
+        if not instance_ids:
+            return set()
+        query = Game.select(Game.instance_id).where(Game.instance_id << list(set(instance_ids)))
+        games = await self.execute(query)
+        if games is None:
+            return None
+        return set(game.instance_id for game in games)
+
     async def close(self):
         await self._objects.close()
+
+
+class WriteBehindBuffer(object):
+    """Collects changed model instances and writes them out together with a single bulk update"""
+
+    def __init__(self, database, fields, batch_size=1000):
+        self.database = database
+        self.fields = fields
+        self.batch_size = batch_size
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, instance):
+        # Later changes to the same row replace earlier ones
+        self._pending[(type(instance), instance.get_id())] = instance
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        by_model = {}
+        for (model, _), instance in pending.items():
+            by_model.setdefault(model, []).append(instance)
+
+        updated = 0
+        for model, instances in by_model.items():
+            count = await self.database.bulk_update(instances, self.fields, self.batch_size)
+            if count is False:
+                # Keep them for the next flush, unless they changed again in the meantime
+                log.error(f"Could not write {len(instances)} buffered {model.__name__} updates, will retry")
+                for instance in instances:
+                    self._pending.setdefault((model, instance.get_id()), instance)
+                continue
+            updated += count
+        if updated:
+            log.debug(f"Wrote {updated} buffered updates")
+        return updated
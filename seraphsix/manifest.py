@@ -0,0 +1,81 @@
+import json
+import logging
+import sqlite3
+
+from functools import lru_cache
+from seraphsix import constants
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS definitions (
+    definition TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (definition, hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class ManifestStore(object):
+    """Local SQLite copy of the manifest definitions the bot uses, with an in-process LRU for lookups"""
+
+    def __init__(self, path, cache_size=constants.MANIFEST_CACHE_SIZE):
+        self.path = path
+        self._db = self._connect()
+        self._db.executescript(SCHEMA)
+        self._lookup = lru_cache(maxsize=cache_size)(self._query)
+
+    def _connect(self):
+        # Loading a new version happens in an executor thread on its own connection,
+        # WAL lets lookups carry on against the old version until it's committed
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    @property
+    def version(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else None
+
+    def load(self, version, definitions):
+        """Replace the stored definitions with the raw JSON content in `definitions`, keyed by definition name"""
+        db = self._connect()
+        try:
+            with db:
+                for definition, content in definitions.items():
+                    entries = json.loads(content)
+                    db.execute('DELETE FROM definitions WHERE definition = ?', (definition,))
+                    db.executemany(
+                        'INSERT INTO definitions (definition, hash, data) VALUES (?, ?, ?)',
+                        (
+                            (definition, int(hash_id), json.dumps(entry, separators=(',', ':')))
+                            for hash_id, entry in entries.items()
+                        )
+                    )
+                    log.info(f"Loaded {len(entries)} {definition} entries from manifest {version}")
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,))
+        finally:
+            db.close()
+        self._lookup.cache_clear()
+
+    def _query(self, definition, hash_id):
+        row = self._db.execute(
+            'SELECT data FROM definitions WHERE definition = ? AND hash = ?', (definition, hash_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def decode(self, hash_id, definition):
+        return self._lookup(definition, int(hash_id))
+
+    def get_name(self, hash_id, definition):
+        entry = self.decode(hash_id, definition)
+        if not entry:
+            return None
+        return entry.get('displayProperties', {}).get('name')
+
+    def close(self):
+        self._db.close()
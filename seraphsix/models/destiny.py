@@ -1,32 +1,42 @@
+import hashlib
+import json
+import zlib
+
+from collections import namedtuple
 from datetime import datetime
+from types import MappingProxyType
 from seraphsix import constants
+from seraphsix.archive import compress_pgcr
 from seraphsix.cogs.utils.helpers import bungie_date_as_utc
 
 
-class UserMembership(object):
-
-    def __init__(self):
-        self.id = None
-        self.username = None
+class UserMembership(namedtuple('UserMembership', ['id', 'username'])):
+    __slots__ = ()
 
-    def __call__(self, details):
-        self.id = int(details['membershipId'])
-        self.username = details['displayName']
+    @classmethod
+    def from_details(cls, details):
+        return cls(int(details['membershipId']), details['displayName'])
 
     def __repr__(self):
         return f"<{type(self).__name__}: {self.username}-{self.id}>"
 
 
+EMPTY_MEMBERSHIP = UserMembership(None, None)
+
+PLATFORM_NAMES = {platform_id: platform for platform, platform_id in constants.PLATFORM_MAP.items()}
+
+
 class User(object):
+    __slots__ = ('memberships', 'primary_membership_id')
 
     class Memberships(object):
-        def __init__(self):
-            self.bungie = UserMembership()
-            self.psn = UserMembership()
-            self.xbox = UserMembership()
-            self.blizzard = UserMembership()
-            self.steam = UserMembership()
-            self.stadia = UserMembership()
+        __slots__ = ('bungie', 'psn', 'xbox', 'blizzard', 'steam', 'stadia')
+
+        def __getattr__(self, name):
+            # Only platforms that are present get set, the rest share an empty membership
+            if name in self.__slots__:
+                return EMPTY_MEMBERSHIP
+            raise AttributeError(name)
 
     def __init__(self, details):
         self.memberships = self.Memberships()
@@ -46,20 +56,12 @@ class User(object):
 
     def _process_membership(self, entry):
         if 'membershipType' not in entry.keys():
-            self.memberships.bungie(entry)
+            platform = 'bungie'
         else:
-            if entry['membershipType'] == constants.PLATFORM_XBOX:
-                self.memberships.xbox(entry)
-            elif entry['membershipType'] == constants.PLATFORM_PSN:
-                self.memberships.psn(entry)
-            elif entry['membershipType'] == constants.PLATFORM_BLIZZARD:
-                self.memberships.blizzard(entry)
-            elif entry['membershipType'] == constants.PLATFORM_STEAM:
-                self.memberships.steam(entry)
-            elif entry['membershipType'] == constants.PLATFORM_STADIA:
-                self.memberships.stadia(entry)
-            elif entry['membershipType'] == constants.PLATFORM_BUNGIE:
-                self.memberships.bungie(entry)
+            platform = PLATFORM_NAMES.get(entry['membershipType'])
+            if not platform:
+                return
+        setattr(self.memberships, platform, UserMembership.from_details(entry))
 
     def to_dict(self):
         return dict(
@@ -79,6 +81,9 @@ class User(object):
 
 
 class Member(User):
+    __slots__ = (
+        'join_date', 'is_online', 'last_online_status_change', 'group_id', 'member_type', 'platform_id', 'member_id'
+    )
 
     def __init__(self, details):
         super().__init__(details)
@@ -88,21 +93,14 @@ class Member(User):
         self.group_id = int(details['groupId'])
         self.member_type = details['memberType']
 
-        if self.memberships.xbox.id:
-            self.platform_id = constants.PLATFORM_XBOX
-            self.member_id = self.memberships.xbox.id
-        elif self.memberships.psn.id:
-            self.platform_id = constants.PLATFORM_PSN
-            self.member_id = self.memberships.psn.id
-        elif self.memberships.blizzard.id:
-            self.platform_id = constants.PLATFORM_BLIZZARD
-            self.member_id = self.memberships.blizzard.id
-        elif self.memberships.steam.id:
-            self.platform_id = constants.PLATFORM_STEAM
-            self.member_id = self.memberships.steam.id
-        elif self.memberships.stadia.id:
-            self.platform_id = constants.PLATFORM_STADIA
-            self.member_id = self.memberships.stadia.id
+        self.platform_id = None
+        self.member_id = None
+        for platform in ('xbox', 'psn', 'blizzard', 'steam', 'stadia'):
+            membership = getattr(self.memberships, platform)
+            if membership.id:
+                self.platform_id = constants.PLATFORM_MAP[platform]
+                self.member_id = membership.id
+                break
 
     def __repr__(self):
         return f"<{type(self).__name__}: {self.platform_id}-{self.member_id}>"
@@ -111,73 +109,131 @@ class Member(User):
         return f"{self.platform_id}-{self.member_id}"
 
 
-class Player(object):
+class Game(object):
+    __slots__ = ('mode_id', 'instance_id', 'reference_id', 'date')
+
     def __init__(self, details):
-        self.membership_id = details['player']['destinyUserInfo']['membershipId']
-        self.membership_type = details['player']['destinyUserInfo']['membershipType']
+        self.mode_id = details['activityDetails']['mode']
+        self.instance_id = int(details['activityDetails']['instanceId'])
+        self.reference_id = details['activityDetails']['referenceId']
+        self.date = bungie_date_as_utc(details['period'])
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {self.instance_id}>"
 
-        self.completed = False
-        if details['values']['completed']['basic']['displayValue'] == 'Yes':
-            self.completed = True
 
-        try:
-            self.name = details['player']['destinyUserInfo']['displayName']
-        except KeyError:
-            self.name = None
+PgcrSummary = namedtuple('PgcrSummary', ['instance_id', 'mode_id', 'reference_id', 'date', 'players'])
 
+
+def summarize_pgcr(pgcr):
+    """Reduce a PGCR to what games are stored from, each player as (type, membership id, time played, completed)"""
+    players = []
+    for entry in pgcr['entries']:
+        user_info = entry['player']['destinyUserInfo']
+        values = entry['values']
         try:
-            self.time_played = details['values']['timePlayedSeconds']['basic']['value']
+            time_played = values['timePlayedSeconds']['basic']['value']
         except KeyError:
-            self.time_played = 0.0
+            time_played = 0.0
+        players.append((
+            int(user_info['membershipType']), int(user_info['membershipId']), time_played,
+            values['completed']['basic']['displayValue'] == 'Yes'
+        ))
 
-    def __repr__(self):
-        return f"<{type(self).__name__}: {self.membership_type}-{self.membership_id}>"
+    details = pgcr['activityDetails']
+    return PgcrSummary(
+        int(details['instanceId']), details['mode'], details['referenceId'], bungie_date_as_utc(pgcr['period']),
+        tuple(players)
+    )
 
 
-class Game(object):
-    def __init__(self, details):
-        self.mode_id = details['activityDetails']['mode']
-        self.instance_id = int(details['activityDetails']['instanceId'])
-        self.reference_id = details['activityDetails']['referenceId']
-        self.date = bungie_date_as_utc(details['period'])
-        self.players = []
+def parse_pgcr(data, compressed=False):
+    """Decode a raw PGCR straight into its summary, picklable so it can run in a worker process"""
+    if compressed:
+        data = zlib.decompress(data)
+    return summarize_pgcr(json.loads(data))
 
-    def set_players(self, details):
-        for entry in details['entries']:
-            player = Player(entry)
-            self.players.append(player)
 
-    def __repr__(self):
-        return f"<{type(self).__name__}: {self.instance_id}>"
+def parse_pgcr_response(data, archive=False):
+    """Decode a raw PGCR API response into (summary, error, PGCR compressed for the archive), picklable too
 
+    Either the summary or the error is set, the compressed PGCR only if the summary is and it was asked for.
+    """
+    response = json.loads(data)
+    if response.get('ErrorCode') != 1:
+        return None, {key: response.get(key) for key in ('ErrorCode', 'ErrorStatus', 'Message')}, None
+    pgcr = response['Response']
+    return summarize_pgcr(pgcr), None, compress_pgcr(pgcr) if archive else None
 
-class ClanGame(Game):
-    def __init__(self, details, member_dbs):
-        super().__init__(details)
-        self.set_players(details)
 
+IndexedMember = namedtuple('IndexedMember', ['member_id', 'clan_id', 'platform_id', 'join_date', 'username'])
+
+
+class ClanMemberIndex(object):
+    """Immutable lookup of clan members by (membership_type, membership_id), built once per sweep
+
+    Only an index of a full clan or server roster has a scope, games are matched against the
+    same members every time within a scope so anything decided from it can be remembered.
+    The scope ends with a digest of the roster, so any change to it starts a new one.
+    """
+
+    __slots__ = ('_members', 'scope')
+
+    def __init__(self, member_dbs, scope=None):
         members = {}
         for member_db in member_dbs:
-            if member_db.psn_id:
-                members.update(
-                    {f'{constants.PLATFORM_PSN}-{member_db.psn_id}': member_db})
-            if member_db.xbox_id:
-                members.update(
-                    {f'{constants.PLATFORM_XBOX}-{member_db.xbox_id}': member_db})
-            if member_db.blizzard_id:
-                members.update(
-                    {f'{constants.PLATFORM_BLIZZARD}-{member_db.blizzard_id}': member_db})
-            if member_db.steam_id:
-                members.update(
-                    {f'{constants.PLATFORM_STEAM}-{member_db.steam_id}': member_db})
-            if member_db.stadia_id:
-                members.update(
-                    {f'{constants.PLATFORM_STADIA}-{member_db.stadia_id}': member_db})
+            for platform, platform_id in constants.PLATFORM_MAP.items():
+                if platform_id == constants.PLATFORM_BUNGIE:
+                    continue
+                membership_id = getattr(member_db, f"{platform}_id")
+                if not membership_id:
+                    continue
+                members[(platform_id, int(membership_id))] = IndexedMember(
+                    member_db.id, member_db.clanmember.clan_id, platform_id,
+                    member_db.clanmember.join_date, getattr(member_db, f"{platform}_username")
+                )
+        self._members = MappingProxyType(members)
+
+        self.scope = None
+        if scope:
+            roster = sorted(
+                f"{key[0]}-{key[1]}-{member.member_id}-{member.clan_id}-{member.join_date}"
+                for key, member in members.items())
+            self.scope = f"{scope}-{hashlib.sha1(','.join(roster).encode('utf-8')).hexdigest()[:16]}"
+
+    def get(self, membership_type, membership_id):
+        return self._members.get((int(membership_type), int(membership_id)))
+
+    def __contains__(self, key):
+        return key in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def __iter__(self):
+        return iter(self._members.values())
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {len(self._members)}>"
+
+
+ClanPlayer = namedtuple('ClanPlayer', ['member_db_id', 'membership_type', 'membership_id', 'time_played', 'completed'])
+
+
+class ClanGame(object):
+    __slots__ = ('mode_id', 'instance_id', 'reference_id', 'date', 'clan_players')
+
+    def __init__(self, summary, member_index):
+        self.instance_id, self.mode_id, self.reference_id, self.date, players = summary
 
         # Loop through all players to find clan members in the game session.
         # Also check if the member joined before the game time.
         self.clan_players = []
-        for player in self.players:
-            player_hash = f"{player.membership_type}-{player.membership_id}"
-            if player_hash in members.keys() and self.date > members[player_hash].clanmember.join_date:
-                self.clan_players.append(player)
+        for membership_type, membership_id, time_played, completed in players:
+            member = member_index.get(membership_type, membership_id)
+            if member and self.date > member.join_date:
+                self.clan_players.append(
+                    ClanPlayer(member.member_id, membership_type, membership_id, time_played, completed))
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {self.instance_id}>"
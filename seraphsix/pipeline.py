@@ -0,0 +1,57 @@
+import aioredis
+
+from pydest import Pydest
+
+from seraphsix.archive import PgcrArchive
+from seraphsix.database import ClanMember, Database, WriteBehindBuffer
+from seraphsix.tasks.activity import bungie_breaker
+from seraphsix.tasks.jobs import JobQueue
+from seraphsix.tasks.parsing import PgcrParser
+from seraphsix.tasks.scheduler import ActivityScheduler
+from seraphsix.transport import HttpTransport
+
+
+class ActivityPipeline(object):
+    """Clients and state the activity tracking tasks need, shared by the bot and the ingestion worker"""
+
+    def setup_pipeline(self, config):
+        self.config = config
+        self.database = Database(config.database_url)
+        self.database.initialize()
+        self.last_active_buffer = WriteBehindBuffer(self.database, [ClanMember.last_active])
+
+        self.transport = HttpTransport(config.http)
+        self.destiny = Pydest(
+            api_key=config.bungie.api_key,
+            client_id=config.bungie.client_id,
+            client_secret=config.bungie.client_secret,
+        )
+
+        self.pgcr_archive = None
+        if config.pgcr_archive_path:
+            self.pgcr_archive = PgcrArchive(config.pgcr_archive_path)
+        self.pgcr_parser = PgcrParser(config.pgcr_workers)
+
+        self.bungie_maintenance = False
+
+    async def connect_redis(self):
+        self.redis = await aioredis.create_redis_pool(self.config.redis_url)
+        self.jobs = JobQueue(self.redis)
+        self.scheduler = ActivityScheduler(self.redis)
+        bungie_breaker.start(self.redis)
+
+    async def attach_transport(self):
+        await self.transport.attach(self.destiny, '_session', 'api.session')
+
+    async def close_pipeline(self, *clients):
+        """Close everything set up for the pipeline, along with any other clients using the transport"""
+        bungie_breaker.stop()
+        await self.transport.close(self.destiny, *clients)
+        await self.last_active_buffer.flush()
+        await self.database.close()
+        if self.pgcr_archive is not None:
+            self.pgcr_archive.close()
+        self.pgcr_parser.close()
+        if hasattr(self, 'redis'):
+            self.redis.close()
+            await self.redis.wait_closed()
@@ -1,15 +1,27 @@
+import aiohttp
 import asyncio
 import backoff
+import inspect
 import logging
 import pydest
+import time
 
+from collections import Counter
+from functools import partial
 from peewee import DoesNotExist, fn, IntegrityError
 from seraphsix import constants
 from seraphsix.cogs.utils.helpers import bungie_date_as_utc
 from seraphsix.database import ClanGame as ClanGameDb, ClanMember, Game, GameMember, Guild, Member
 from seraphsix.errors import MaintenanceError
-from seraphsix.models.destiny import Game as GameApi, ClanGame
-from ratelimit import limits, RateLimitException
+from seraphsix.models.destiny import Game as GameApi, ClanGame, ClanMemberIndex, Member as MemberApi
+from seraphsix.tasks.breaker import CircuitBreaker
+from seraphsix.tasks.cache import ResponseCache
+from seraphsix.tasks.claim import ClaimLock
+from seraphsix.tasks.flight import SingleFlight
+from seraphsix.tasks.instances import InstanceFilter
+from seraphsix.tasks.limiter import TokenBucketLimiter
+from seraphsix.tasks.parsing import PgcrParser
+from seraphsix.tasks.sweep import run_sweep
 
 log = logging.getLogger(__name__)
 
@@ -36,12 +48,29 @@ def parse_platform(member_db, platform_id):
     return member_id, member_username
 
 
-def backoff_hdlr(details):
-    if details['wait'] > 30 or details['tries'] > 10:
-        log.info(
-            f"Backing off {details['wait']:0.1f} seconds after {details['tries']} tries "
-            f"for {details['args'][3]}-{details['args'][2]}"
-        )
+# Shared by every process talking to Bungie, since the bucket state lives in Redis
+bungie_limiter = TokenBucketLimiter(
+    'bungie', constants.BUNGIE_RATE_LIMIT, endpoint_limits=constants.BUNGIE_ENDPOINT_RATE_LIMITS,
+    reserves=constants.BUNGIE_PRIORITY_RESERVES)
+
+# Responses commands and syncs ask for over and over, shared with other processes through Redis
+bungie_cache = ResponseCache('bungie', constants.BUNGIE_CACHE_TTLS)
+
+# Stops calls during Bungie maintenance in every process once any of them runs into it
+bungie_breaker = CircuitBreaker('bungie-maintenance', constants.TIME_MIN_SECONDS)
+
+# Members of the same fireteam ask for the same carnage report at the same time
+bungie_flight = SingleFlight('bungie')
+
+# Games being stored, so processes don't fetch the same carnage report at the same time
+game_claims = ClaimLock('game', constants.GAME_CLAIM_TTL)
+
+# Games found in history that are already stored, or that didn't have enough members of
+# a clan or server in them going by its full roster, so they don't have to be looked up
+# again every time they come up. Rejections only hold for the roster they were decided
+# from, syncing new members gives the roster a new scope.
+stored_games = InstanceFilter('stored', constants.INSTANCE_FILTER_RETENTION, constants.INSTANCE_FILTER_REFRESH)
+rejected_games = InstanceFilter('rejected', constants.INSTANCE_FILTER_RETENTION, constants.INSTANCE_FILTER_REFRESH)
 
 
 @backoff.on_exception(
@@ -50,27 +79,68 @@ def backoff_hdlr(details):
     max_tries=1, logger=None)
 @backoff.on_exception(backoff.expo, pydest.pydest.PydestException, max_tries=100, logger=None)
 @backoff.on_exception(backoff.expo, asyncio.TimeoutError, max_tries=1)
-@backoff.on_exception(backoff.expo, RateLimitException, max_tries=100, logger=None, on_backoff=backoff_hdlr)
-@limits(calls=25, period=1)
-async def execute_pydest(function, redis, member_id=None, caller=None):
-    is_maintenance = await redis.get('global-bungie-maintenance')
-    if is_maintenance and eval(is_maintenance):
-        await function()
+async def execute_pydest(
+        function, redis, member_id=None, caller=None, priority=constants.PRIORITY_INTERACTIVE, cache=True):
+    endpoint = function.__name__
+    # Arguments of a coroutine that hasn't started yet are its only locals
+    args = inspect.getcoroutinelocals(function)
+    if cache and bungie_cache.cacheable(endpoint):
+        data = await bungie_cache.get(redis, endpoint, args)
+        if data:
+            function.close()
+            return data
+
+    execute = partial(
+        _execute_pydest, redis=redis, endpoint=endpoint, args=args, member_id=member_id, caller=caller,
+        priority=priority)
+    if endpoint not in constants.BUNGIE_SINGLE_FLIGHT_ENDPOINTS:
+        return await execute(function)
+
+    # Calls only share a request with others at the same priority, otherwise a command could
+    # end up waiting behind the reserve kept back from background sweeps
+    key = f"{priority}-{bungie_flight.key(endpoint, args)}"
+    return await bungie_flight.run(endpoint, key, function, execute)
+
+
+async def _execute_pydest(function, redis, endpoint, args, member_id, caller, priority):
+    if not await bungie_breaker.allow():
+        function.close()
         raise MaintenanceError
+    await bungie_limiter.acquire(redis, endpoint, priority)
     try:
-        return await asyncio.create_task(function)
+        data = await function
     except pydest.pydest.PydestMaintenanceException as e:
-        await redis.set('global-bungie-maintenance', str(True), expire=constants.TIME_MIN_SECONDS)
+        await bungie_breaker.trip(redis)
         log.error(e)
         raise MaintenanceError
+    except pydest.pydest.PydestException as e:
+        if type(e) is pydest.pydest.PydestException:
+            # Raised as is when Bungie couldn't be reached or didn't answer with JSON
+            await bungie_breaker.fail(redis)
+        else:
+            # An error Bungie answered with still means it is up
+            await bungie_breaker.reset(redis)
+        raise
     except RuntimeError as e:
         log.error(f"{member_id} {caller} {e}")
+        await bungie_breaker.fail(redis)
         return None
-
-
-async def get_activity_history(destiny, redis, platform_id, member_id, char_id, count):
-    function = destiny.api.get_activity_history(platform_id, member_id, char_id, count=count)
-    data = await execute_pydest(function, redis, member_id, 'get_activity_history')
+    except asyncio.CancelledError:
+        bungie_breaker.abandon()
+        raise
+    except Exception:
+        await bungie_breaker.fail(redis)
+        raise
+    await bungie_breaker.reset(redis)
+
+    if bungie_cache.cacheable(endpoint) and isinstance(data, dict) and data.get('ErrorCode') == 1:
+        await bungie_cache.set(redis, endpoint, args, data)
+    return data
+
+
+async def get_activity_history(destiny, redis, platform_id, member_id, char_id, count, page=0):
+    function = destiny.api.get_activity_history(platform_id, member_id, char_id, count=count, page=page)
+    data = await execute_pydest(function, redis, member_id, 'get_activity_history', constants.PRIORITY_BACKGROUND)
     try:
         activities = data['Response']['activities']
     except (KeyError, TypeError):
@@ -78,35 +148,153 @@ async def get_activity_history(destiny, redis, platform_id, member_id, char_id,
     return activities
 
 
-async def get_pgcr(destiny, redis, activity_id):
-    function = destiny.api.get_post_game_carnage_report(activity_id)
-    data = await execute_pydest(function, redis, activity_id, 'get_pgcr')
-    pgcr = data['Response']
-    return pgcr
+async def get_post_game_carnage_report(session, api_key, activity_id):
+    """The same request pydest makes, but the response is left for the PGCR parser to decode"""
+    url = f"{constants.PGCR_URL}{activity_id}/"
+    try:
+        async with session.get(url, headers={'X-API-KEY': api_key}) as response:
+            if response.content_type != 'application/json':
+                raise pydest.pydest.PydestException("Could not connect to Bungie.net")
+            return await response.read()
+    except aiohttp.ClientResponseError:
+        raise pydest.pydest.PydestException("Could not connect to Bungie.net")
+
 
+async def get_pgcr(bot, activity_id):
+    function = get_post_game_carnage_report(bot.transport.connect(), bot.config.bungie.api_key, activity_id)
+    return await execute_pydest(function, bot.redis, activity_id, 'get_pgcr', constants.PRIORITY_BACKGROUND)
 
-async def get_characters(destiny, redis, member_id, platform_id, caller=None):
+
+async def get_characters(destiny, redis, member_id, platform_id, caller=None, priority=constants.PRIORITY_BACKGROUND):
     function = destiny.api.get_profile(platform_id, member_id, [constants.COMPONENT_CHARACTERS])
-    data = await execute_pydest(function, redis, member_id, caller)
+    data = await execute_pydest(function, redis, member_id, caller, priority)
     characters = data['Response']['characters']['data']
     return characters
 
 
-async def decode_activity(destiny, redis, reference_id):
-    await execute_pydest(destiny.update_manifest(), reference_id, 'decode_activity')
-    function = destiny.decode_hash(reference_id, 'DestinyActivityDefinition')
-    return await execute_pydest(function, redis, reference_id, 'decode_activity')
+async def update_manifest(destiny, redis, manifest, language='en'):
+    data = await execute_pydest(
+        destiny.api.get_destiny_manifest(), redis, caller='update_manifest', priority=constants.PRIORITY_SYNC)
+    try:
+        version = data['Response']['version']
+        paths = data['Response']['jsonWorldComponentContentPaths'][language]
+    except (KeyError, TypeError):
+        log.error(f"Could not get the manifest version: {data}")
+        return False
+
+    if version == manifest.version:
+        return False
+
+    # Only the definitions that are used get downloaded, each one is a separate file
+    definitions = {}
+    for definition in constants.MANIFEST_DEFINITIONS:
+        # These files are far bigger than any API response, so they get a timeout of their own
+        url = f"{constants.BUNGIE_BASE_URL}{paths[definition]}"
+        timeout = aiohttp.ClientTimeout(total=constants.MANIFEST_DOWNLOAD_TIMEOUT)
+        async with destiny.api.session.get(url, timeout=timeout) as response:
+            response.raise_for_status()
+            definitions[definition] = await response.read()
+
+    await asyncio.get_event_loop().run_in_executor(None, manifest.load, version, definitions)
+    log.info(f"Updated the manifest to version {version}")
+    return True
+
+
+def decode_activity(manifest, reference_id):
+    return manifest.decode(reference_id, 'DestinyActivityDefinition')
+
 
+def activity_cursor_key(platform_id, member_id):
+    return f"activity-cursor-{platform_id}-{member_id}"
 
-async def get_activity_list(destiny, redis, platform_id, member_id, char_ids, count):
-    all_activity_ids = []
-    for char_id in char_ids:
+
+async def get_activity_cursors(redis, platform_id, member_id):
+    # Each character's cursor is the period timestamp and instance id of the newest
+    # activity that has already been processed, and the character's last played date
+    # when it was scanned, stored as "<timestamp>:<instance_id>:<last_played>"
+    stored = await redis.hgetall(activity_cursor_key(platform_id, member_id), encoding='utf-8')
+    cursors = {}
+    for char_id, cursor in (stored or {}).items():
+        timestamp, instance_id, *last_played = map(int, cursor.split(':'))
+        # Cursors saved before the last played date was kept have to be scanned once more
+        cursors[int(char_id)] = (timestamp, instance_id, last_played[0] if last_played else None)
+    return cursors
+
+
+async def set_activity_cursors(redis, platform_id, member_id, cursors):
+    if not cursors:
+        return
+    await redis.hmset_dict(
+        activity_cursor_key(platform_id, member_id),
+        {char_id: ':'.join(map(str, cursor)) for char_id, cursor in cursors.items()}
+    )
+
+
+async def iter_activity_history(destiny, redis, platform_id, member_id, char_id, count,
+                                cutoff=None, max_pages=None, start_page=0):
+    page = start_page
+    while max_pages is None or page < start_page + max_pages:
         activities = await get_activity_history(
-            destiny, redis, platform_id, member_id, char_id, count=count)
+            destiny, redis, platform_id, member_id, char_id, count=count, page=page)
         if not activities:
+            return
+
+        yield page, activities
+
+        # A short page is the last one, and since history is ordered newest first
+        # there is no point in fetching pages that are entirely older than the cutoff
+        if len(activities) < count or (cutoff and bungie_date_as_utc(activities[-1]['period']) < cutoff):
+            return
+        page += 1
+
+
+async def iter_activity_list(destiny, redis, platform_id, member_id, characters, count,
+                             cursors, new_cursors, cutoff=None, full_sync=False, start_pages=None):
+    if not start_pages:
+        start_pages = {}
+
+    for char_id, character in characters.items():
+        char_id = int(char_id)
+        cursor = cursors.get(char_id)
+        start_page = start_pages.get(char_id, 0)
+        last_played = int(bungie_date_as_utc(character['dateLastPlayed']).timestamp())
+
+        # A character that hasn't been played since its history was last scanned has
+        # nothing new to fetch
+        if cursor and cursor[2] is not None and last_played <= cursor[2]:
             continue
-        all_activity_ids.extend([activity for activity in activities])
-    return all_activity_ids
+
+        # Without a cursor only the most recent page is scanned, unless this is a full sync.
+        # With one, keep paging until the cursor (or the cutoff) is reached.
+        max_pages = None if cursor or full_sync else 1
+
+        reached_cursor = False
+        async for page, activities in iter_activity_history(
+                destiny, redis, platform_id, member_id, char_id, count, cutoff, max_pages, start_page):
+            new_activities = []
+            for activity in activities:
+                timestamp = int(bungie_date_as_utc(activity['period']).timestamp())
+                instance_id = int(activity['activityDetails']['instanceId'])
+
+                # History is returned newest first, so everything from here on has been seen
+                if cursor and (instance_id == cursor[1] or timestamp < cursor[0]):
+                    reached_cursor = True
+                    break
+
+                # A scan resumed part way through never saw the newest activities
+                if char_id not in new_cursors and not start_page:
+                    new_cursors[char_id] = (timestamp, instance_id, last_played)
+                new_activities.append(activity)
+
+            if new_activities:
+                yield char_id, page, new_activities
+
+            if reached_cursor:
+                break
+
+        # Nothing new was found, but the scan still counts as having seen this last played date
+        if cursor and char_id not in new_cursors and not start_page:
+            new_cursors[char_id] = (cursor[0], cursor[1], last_played)
 
 
 async def get_last_active(destiny, redis, member_db):
@@ -117,7 +305,7 @@ async def get_last_active(destiny, redis, member_db):
     try:
         characters = await get_characters(destiny, redis, member_id, platform_id, 'get_last_active')
         characters = characters.items()
-    except AttributeError:
+    except (AttributeError, KeyError, TypeError):
         log.error(f"Could not get character data for {platform_id}-{member_id}")
         return acct_last_active
 
@@ -131,8 +319,84 @@ async def get_last_active(destiny, redis, member_db):
 
 async def store_last_active(bot, member_db):
     last_active = await get_last_active(bot.destiny, bot.redis, member_db)
+    if not last_active:
+        return member_db.clanmember.last_active
+    return await save_last_active(bot, member_db, last_active)
+
+
+async def save_last_active(bot, member_db, last_active):
+    previous = member_db.clanmember.last_active
+    if last_active == previous:
+        return previous
+
+    # Written out in bulk at the end of the sweep
     member_db.clanmember.last_active = last_active
-    await bot.database.update(member_db.clanmember)
+    bot.last_active_buffer.add(member_db.clanmember)
+
+    # Having played since the last check means there are new games to find, so scan
+    # the member's history now instead of waiting for the next games sweep
+    if previous and last_active > previous:
+        clan_db = member_db.clanmember.clan
+        await bot.jobs.enqueue('scan', member_id=member_db.id, clan_id=clan_db.clan_id, guild=clan_db.guild_id)
+    return last_active
+
+
+def member_platform_key(member_db):
+    platform_id = member_db.clanmember.platform_id
+    member_id, _ = parse_platform(member_db, platform_id)
+    return f"{platform_id}-{member_id}"
+
+
+def presence_key(clan_id):
+    return f"presence-{clan_id}"
+
+
+async def get_clan_roster(bot, clan_db, caller):
+    data = await execute_pydest(
+        bot.destiny.api.get_group_members(clan_db.clan_id), bot.redis, clan_db.clan_id, caller,
+        constants.PRIORITY_BACKGROUND)
+    try:
+        return data['Response']['results']
+    except (KeyError, TypeError):
+        log.error(f"Could not get the roster for clan {clan_db.clan_id}")
+        return None
+
+
+async def get_changed_presence(bot, clan_db, member_dbs):
+    # One roster call covers the whole clan, profiles are then only needed for members
+    # whose online status changed since the last poll
+    results = await get_clan_roster(bot, clan_db, 'get_changed_presence')
+    if results is None:
+        return []
+
+    key = presence_key(clan_db.clan_id)
+    previous = await bot.redis.hgetall(key, encoding='utf-8') or {}
+    members = {member_platform_key(member_db): member_db for member_db in member_dbs}
+
+    changed = []
+    roster = set()
+    for result in results:
+        member = MemberApi(result)
+        field = str(member)
+        roster.add(field)
+        state = f"{member.is_online}:{result['lastOnlineStatusChange']}"
+        if field in members and previous.get(field) != state:
+            changed.append((members[field], key, field, state))
+
+    # Members who left are taken care of by the member sync, just forget their status
+    departed = set(previous) - roster
+    if departed:
+        await bot.redis.hdel(key, *departed)
+    return changed
+
+
+async def store_presence_last_active(bot, member_db, key, field, state):
+    last_active = await get_last_active(bot.destiny, bot.redis, member_db)
+    if not last_active:
+        return
+    await save_last_active(bot, member_db, last_active)
+    # Only recorded once the profile was fetched, so a failure is retried on the next poll
+    await bot.redis.hset(key, field, state)
 
 
 async def get_game_counts(database, game_mode, member_db=None):
@@ -207,107 +471,273 @@ async def get_sherpa_time_played(database, member_db):
     return (total_time, unique_sherpas)
 
 
-async def store_game_member(bot, player, game_db, member_db):
-    player_db = await bot.database.get_clan_member_by_platform(
-        player.membership_id, player.membership_type, member_db.clanmember.clan_id)
+def get_game_members(clan_game, game_db):
+    # A player that dropped and re-joined shows up as multiple entries, so combine
+    # those here since a single upsert can't touch the same row twice
+    game_members = {}
+    for player in clan_game.clan_players:
+        try:
+            game_member = game_members[player.member_db_id]
+        except KeyError:
+            game_members[player.member_db_id] = dict(
+                member=player.member_db_id, game=game_db.id,
+                completed=player.completed, time_played=player.time_played)
+        else:
+            game_member['time_played'] += player.time_played
+            game_member['completed'] = game_member['completed'] or player.completed
+    return list(game_members.values())
+
+
+async def store_game_members(bot, clan_game, game_db):
+    game_members = get_game_members(clan_game, game_db)
+    if not game_members:
+        return
+
+    # If a member already exists in this game, we can assume this is due to a
+    # drop/re-join event so the upsert increments the time played and merges the
+    # completion flag
+    await bot.database.upsert_game_members(game_members)
+    log.debug(f"{len(game_members)} players created in game id {game_db.instance_id}")
+
+
+async def get_pgcr_summaries(bot, instance_ids):
+    # Prefer locally archived copies, and archive anything fetched from Bungie. Reports are
+    # only handled undecoded here, the parser turns each batch of them into summaries off
+    # the loop, and compresses fetched ones for the archive while it is at it.
+    # The archive is shared with other processes and waits on their file lock, so it is
+    # only ever used from executor threads.
+    loop = asyncio.get_event_loop()
+    archived = {}
+    if bot.pgcr_archive is not None:
+        datas = await loop.run_in_executor(
+            None, lambda: [bot.pgcr_archive.get_raw(instance_id) for instance_id in instance_ids])
+        archived = {instance_id: data for instance_id, data in zip(instance_ids, datas) if data}
+
+    fetched = {}
+    for instance_id in instance_ids:
+        if instance_id in archived:
+            continue
+        data = await get_pgcr(bot, instance_id)
+        if not data:
+            log.error(f"Could not get post game carnage report for game {instance_id}")
+            continue
+        fetched[instance_id] = data
+
+    summaries = dict(zip(archived, await bot.pgcr_parser.parse_many(archived.values(), compressed=True)))
+    responses = await bot.pgcr_parser.parse_responses(fetched.values(), archive=bot.pgcr_archive is not None)
+
+    compressed_pgcrs = []
+    for instance_id, (summary, error, compressed) in zip(fetched, responses):
+        if error and error['ErrorCode'] == constants.BUNGIE_ERROR_SYSTEM_DISABLED:
+            await bungie_breaker.trip(bot.redis)
+            log.error(error)
+            raise MaintenanceError
+        if error:
+            log.error(f"Could not get post game carnage report for game {instance_id}: {error}")
+            continue
+        summaries[instance_id] = summary
+        if compressed:
+            compressed_pgcrs.append((instance_id, compressed))
+
+    if compressed_pgcrs:
+        await loop.run_in_executor(
+            None, lambda: [bot.pgcr_archive.add_raw(instance_id, data) for instance_id, data in compressed_pgcrs])
+    return summaries
+
+
+async def store_games(bot, member_index, member_db, games):
+    """Whether each game was stored, None for those that aren't done yet"""
+    # Members who played together are scanned in parallel, possibly by other processes,
+    # so only whoever claims a game first fetches its carnage report. Everyone else
+    # treats it as not done yet and finds it stored next time around.
+    stored = dict.fromkeys(game.instance_id for game in games)
+    claimed = []
+    for game in games:
+        if await game_claims.claim(bot.redis, game.instance_id):
+            claimed.append(game)
+        else:
+            log.debug(f"Continuing because game {game.instance_id} is claimed elsewhere")
 
     try:
-        # Create the game member
-        await bot.database.create(
-            GameMember, member=player_db.id, game=game_db.id,
-            completed=player.completed, time_played=player.time_played)
+        summaries = await get_pgcr_summaries(bot, [game.instance_id for game in claimed])
+        for game in claimed:
+            summary = summaries.get(game.instance_id)
+            if not summary:
+                log.debug(f"Continuing because error with game {game.instance_id}")
+                continue
+            stored[game.instance_id] = await store_claimed_game(bot, member_index, member_db, game, summary)
+    finally:
+        # A stored game keeps its claim until it expires, in case another scan already
+        # decided it wasn't stored before it was
+        for game in claimed:
+            if not stored[game.instance_id]:
+                await game_claims.release(bot.redis, game.instance_id)
+    return stored
+
+
+async def store_claimed_game(bot, member_index, member_db, game, summary):
+    clan_game = ClanGame(summary, member_index)
+
+    # Check if player count is below the threshold
+    game_mode_details = constants.MODE_MAP[game.mode_id]
+    if len(clan_game.clan_players) < game_mode_details['threshold']:
+        log.debug(f"Continuing because not enough clan players in game {game.instance_id}")
+        if member_index.scope:
+            await rejected_games.add(bot.redis, [(game.instance_id, game.date)], member_index.scope)
+        return False
+
+    try:
+        game_db = await bot.database.create(
+            Game, mode_id=clan_game.mode_id, instance_id=clan_game.instance_id,
+            date=clan_game.date, reference_id=clan_game.reference_id)
     except IntegrityError:
-        # If one already exists, we can assume this is due to a drop/re-join event so
-        # increment the time played and set the completion flag
-        game_member_db = await bot.database.get(GameMember, game=game_db.id, member=player_db.id)
-        game_member_db.time_played += player.time_played
+        # Only possible if a claim expired while its holder was still working on the game
+        await stored_games.add(bot.redis, [(game.instance_id, game.date)])
+        return False
+    await stored_games.add(bot.redis, [(game.instance_id, game.date)])
 
-        if not game_member_db.completed or game_member_db.completed != player.completed:
-            game_member_db.completed = player.completed
-        await bot.database.update(game_member_db)
+    game_title = game_mode_details['title'].title()
+    log.info(f"{game_title} game id {game.instance_id} created")
 
-    log.debug(f"Player {player.membership_id} created in game id {game_db.instance_id}")
+    try:
+        await bot.database.get(ClanGameDb, clan=member_db.clanmember.clan_id, game=game_db.id)
+    except DoesNotExist:
+        await bot.database.create(ClanGameDb, clan=member_db.clanmember.clan_id, game=game_db.id)
+        await store_game_members(bot, clan_game, game_db)
+    return True
 
 
-async def store_member_history(member_dbs, bot, member_db, count):
+async def store_member_history(member_index, bot, member_db, count, full_sync=False, checkpoint=None):
     platform_id = member_db.clanmember.platform_id
     member_id, member_username = parse_platform(member_db, platform_id)
 
     try:
         characters = await get_characters(bot.destiny, bot.redis, member_id, platform_id, 'store_member_history')
-        char_ids = characters.keys()
     except (KeyError, TypeError):
+        characters = None
+
+    if characters is None:
         log.error(f"Could not get character data for {platform_id}-{member_id}")
         return
 
-    all_activities = await get_activity_list(
-        bot.destiny, bot.redis, platform_id, member_id, char_ids, count
-    )
+    # Games that occurred before Forsaken released (ie. Season 4), before a configured
+    # cutoff date, or before the member joined are not eligible, so there is no need
+    # to page through history any older than that
+    cutoff = max(constants.FORSAKEN_RELEASE, bot.config.activity_cutoff, member_db.clanmember.join_date)
+    supported_modes = set(sum(constants.SUPPORTED_GAME_MODES.values(), []))
+    await stored_games.load(bot.redis)
+    await rejected_games.load(bot.redis)
 
-    mode_count = 0
-    for activity in all_activities:
-        game = GameApi(activity)
+    cursors = await get_activity_cursors(bot.redis, platform_id, member_id)
+    new_cursors = {}
 
-        try:
-            await bot.database.get(Game, instance_id=game.instance_id)
-        except DoesNotExist:
-            pass
-        else:
-            log.debug(f"Continuing because game {game.instance_id} exists")
-            continue
+    # Pick a previously interrupted scan up from the page it got to for each character
+    start_pages = {}
+    if checkpoint:
+        start_pages = {int(char_id): int(page) for char_id, page in (await checkpoint.load()).items()}
 
-        # Check if the game occurred before Forsaken released (ie. Season 4), or
-        # if the game occurred before a configured cutoff date, or if the member
-        # joined before game time, or if the game is not a supported one.
-        # If any of those apply, the game is not eligible.
-        supported_modes = set(sum(constants.SUPPORTED_GAME_MODES.values(), []))
-        if (game.date < constants.FORSAKEN_RELEASE or
-                game.date < bot.config.activity_cutoff or
-                game.date < member_db.clanmember.join_date or
-                game.mode_id not in supported_modes):
-            log.debug(f"Continuing because game {game.instance_id} isn't eligible")
-            continue
-
-        pgcr = await get_pgcr(bot.destiny, bot.redis, game.instance_id)
-        if not pgcr:
-            log.error(f"{member_username}: {pgcr}")
-            log.debug(f"Continuing because error with game {game.instance_id}")
-            continue
+    mode_count = 0
+    has_errors = False
+    async for char_id, page, activities in iter_activity_list(  # pylint: disable=not-an-iterable
+            bot.destiny, bot.redis, platform_id, member_id, characters, count,
+            cursors, new_cursors, cutoff, full_sync, start_pages):
+        games = []
+        for activity in activities:
+            game = GameApi(activity)
+            rejected = member_index.scope and rejected_games.contains(game.instance_id, member_index.scope)
+            if stored_games.contains(game.instance_id) or rejected:
+                log.debug(f"Continuing because game {game.instance_id} was seen before")
+                continue
+
+            # Check if the game occurred before the cutoff date, or if the game is
+            # not a supported one. If either apply, the game is not eligible.
+            if game.date < cutoff or game.mode_id not in supported_modes:
+                log.debug(f"Continuing because game {game.instance_id} isn't eligible")
+                continue
+            games.append(game)
+
+        # Resolve which of the candidate games are already stored in a single query
+        # instead of looking up each one individually
+        existing_ids = await bot.database.get_existing_instance_ids([game.instance_id for game in games])
+        if existing_ids is None:
+            log.error(f"Could not look up existing games for {platform_id}-{member_id}")
+            has_errors = True
+            break
+        await stored_games.add(
+            bot.redis, [(game.instance_id, game.date) for game in games if game.instance_id in existing_ids])
+
+        new_games = []
+        for game in games:
+            if game.instance_id in existing_ids:
+                log.debug(f"Continuing because game {game.instance_id} exists")
+                continue
+            new_games.append(game)
+
+        for start in range(0, len(new_games), constants.PGCR_BATCH_SIZE):
+            batch = new_games[start:start + constants.PGCR_BATCH_SIZE]
+            stored = await store_games(bot, member_index, member_db, batch)
+            has_errors = has_errors or None in stored.values()
+            mode_count += sum(1 for game_stored in stored.values() if game_stored)
+
+        if checkpoint and not has_errors:
+            await checkpoint.save(char_id, page + 1)
+
+    # Only move the cursors forward once everything up to them has been processed,
+    # otherwise the failed games would never be looked at again. The same goes for games
+    # matched against only part of the roster, they may still count for the full one.
+    if not has_errors and member_index.scope:
+        await set_activity_cursors(bot.redis, platform_id, member_id, new_cursors)
 
-        clan_game = ClanGame(pgcr, member_dbs)
+    if mode_count:
+        log.debug(f"Found {mode_count} games for {member_username}")
+        return mode_count
 
-        # Check if player count is below the threshold
-        game_mode_details = constants.MODE_MAP[game.mode_id]
-        if len(clan_game.clan_players) < game_mode_details['threshold']:
-            log.debug(f"Continuing because not enough clan players in game {game.instance_id}")
-            continue
 
-        try:
-            game_db = await bot.database.create(Game, **vars(clan_game))
-        except IntegrityError:
-            # Mitigate possible race condition when multiple parallel jobs try to
-            # do the same thing. Likely when there are multiple people in the same
-            # game instance.
-            # TODO: Figure out a better way to 'lock' things
-            continue
-
-        game_title = game_mode_details['title'].title()
-        log.info(f"{game_title} game id {game.instance_id} created")
-        mode_count += 1
+async def run_member_history_job(bot, job, count, full_sync=False):
+    try:
+        member_db = await bot.database.get_clan_member_by_member_id(job.payload['member_id'], job.payload['clan_id'])
+    except DoesNotExist:
+        log.info(f"Skipping job {job} because the member is no longer in the clan")
+        return
 
+    if 'guild' in job.payload:
+        guild_db = await bot.database.get(Guild, id=job.payload['guild'])
+        clan_dbs = [
+            clan_db for clan_db in await bot.database.get_clans_by_guild(guild_db.guild_id)
+            if clan_db.activity_tracking
+        ]
+        member_indexes = await get_member_indexes(bot.database, guild_db, clan_dbs)
         try:
-            await bot.database.get(ClanGameDb, clan=member_db.clanmember.clan_id, game=game_db.id)
-        except DoesNotExist:
-            await bot.database.create(ClanGameDb, clan=member_db.clanmember.clan_id, game=game_db.id)
-            tasks = [
-                store_game_member(bot, player, game_db, member_db)
-                for player in clan_game.clan_players
-            ]
-            await asyncio.gather(*tasks)
-
-    if mode_count:
-        log.debug(f"Found {mode_count} games for {member_username}")
-        return mode_count
+            member_index = member_indexes[member_db.clanmember.clan_id]
+        except KeyError:
+            log.info(f"Skipping job {job} because activity tracking is disabled for the clan")
+            return
+    else:
+        # Queued before jobs carried their server, so it's unknown whether clans are
+        # aggregated. Without a scope the scan neither moves cursors nor rejects games.
+        member_index = ClanMemberIndex(await bot.database.get_clan_members([job.payload['clan_id']]))
+    await store_member_history(member_index, bot, member_db, count, full_sync=full_sync, checkpoint=job.checkpoint)
+
+
+def get_job_handlers(bot):
+    return {
+        'backfill': lambda job: run_member_history_job(bot, job, count=250, full_sync=True),
+        'scan': lambda job: run_member_history_job(bot, job, count=30),
+    }
+
+
+async def get_member_indexes(database, guild_db, clan_dbs):
+    """Full roster index of each clan, one shared by all of them when the server aggregates its clans"""
+    member_dbs = list(await database.get_clan_members([clan_db.clan_id for clan_db in clan_dbs]) or [])
+    if guild_db.aggregate_clans:
+        guild_index = ClanMemberIndex(member_dbs, scope=f"guild-{guild_db.id}")
+        return {clan_db.id: guild_index for clan_db in clan_dbs}
+    return {
+        clan_db.id: ClanMemberIndex(
+            (member_db for member_db in member_dbs if member_db.clanmember.clan_id == clan_db.id),
+            scope=f"clan-{clan_db.id}")
+        for clan_db in clan_dbs
+    }
 
 
 async def store_all_games(bot, guild_id, count=30):
@@ -320,27 +750,271 @@ async def store_all_games(bot, guild_id, count=30):
 
     log.info(f"Finding all games for members of server {guild_id} active in the last hour")
 
-    tasks = []
-    member_dbs = []
+    tracked_clan_dbs = []
     for clan_db in clan_dbs:
         if not clan_db.activity_tracking:
             log.info(f"Clan activity tracking disabled for Clan {clan_db.name}, skipping")
             continue
-
-        active_members = await bot.database.get_clan_members_active(clan_db.id, hours=1)
-        if guild_db.aggregate_clans:
-            member_dbs.extend(active_members)
-        else:
-            member_dbs = active_members
-
-        tasks.extend([
-            store_member_history(member_dbs, bot, member_db, count)
-            for member_db in member_dbs
-        ])
-
-    results = await asyncio.gather(*tasks)
+        tracked_clan_dbs.append(clan_db)
+
+    # Only members active in the last hour are scanned, but their games are matched
+    # against everyone in the clan, or the whole server when clans are aggregated
+    member_indexes = await get_member_indexes(bot.database, guild_db, tracked_clan_dbs)
+    items = []
+    for clan_db in tracked_clan_dbs:
+        for member_db in await bot.database.get_clan_members_active(clan_db.id, hours=1) or []:
+            items.append((member_indexes[clan_db.id], member_db))
+    results = await run_sweep(
+        f"games-{guild_id}", items,
+        lambda item: store_member_history(item[0], bot, item[1], count),
+        bot.config.sweep_concurrency
+    )
 
     log.info(
         f"Found {sum(filter(None, results))} games for members "
         f"of server {guild_id} active in the last hour"
     )
+
+
+async def store_all_guild_games(bot):
+    guilds = await bot.database.execute(Guild.select())
+    if not guilds:
+        return
+
+    # Each guild's sweep is already concurrent, so run them one at a time to
+    # keep the number of in-flight members bounded
+    for guild in guilds:
+        await store_all_games(bot, guild.guild_id)
+
+
+async def get_all_clan_members(bot):
+    clans = []
+    guilds = await bot.database.execute(Guild.select())
+    for guild in guilds or []:
+        log.info(f"Finding last active dates for all members of server {guild.guild_id}")
+        guild_members = {}
+        for member_db in await bot.database.get_clan_members_by_guild_id(guild.guild_id) or []:
+            guild_members.setdefault(member_db.clanmember.clan_id, []).append(member_db)
+        for clan_db in await bot.database.get_clans_by_guild(guild.guild_id) or []:
+            clans.append((clan_db, guild_members.get(clan_db.id, [])))
+    return clans
+
+
+async def store_all_presence_last_active(bot):
+    clans = await get_all_clan_members(bot)
+    if not clans:
+        return
+
+    results = await run_sweep(
+        'presence', clans, lambda item: get_changed_presence(bot, *item), bot.config.sweep_concurrency)
+    changed = [entry for result in results for entry in result]
+    log.info(f"Found {len(changed)} members with a changed online status")
+
+    await run_sweep(
+        'last-active', changed, lambda entry: store_presence_last_active(bot, *entry),
+        bot.config.sweep_concurrency)
+
+    log.info("Found last active dates in all guilds")
+
+
+async def get_online_members(bot, clan_db):
+    results = await get_clan_roster(bot, clan_db, 'get_online_members')
+    online = set()
+    for result in results or []:
+        member = MemberApi(result)
+        if member.is_online:
+            online.add(f"{clan_db.clan_id}-{member}")
+    return online
+
+
+async def store_scheduled_last_active(bot, member_db, entry, is_online):
+    last_active = await store_last_active(bot, member_db)
+    scheduler = bot.scheduler
+    await scheduler.schedule(entry, scheduler.classify(last_active, is_online))
+
+
+async def store_all_scheduled_last_active(bot):
+    clans = await get_all_clan_members(bot)
+    if not clans:
+        return
+
+    scheduler = bot.scheduler
+    now = time.time()
+
+    # Rosters are only polled to find who is online right now, one call per clan
+    results = await run_sweep(
+        'online', [clan_db for clan_db, _ in clans], lambda clan_db: get_online_members(bot, clan_db),
+        bot.config.sweep_concurrency)
+    online = set().union(*results)
+
+    members = {}
+    member_online = {}
+    for clan_db, member_dbs in clans:
+        for member_db in member_dbs:
+            entry = f"{clan_db.clan_id}-{member_db.id}"
+            members[entry] = member_db
+            member_online[entry] = f"{clan_db.clan_id}-{member_platform_key(member_db)}" in online
+
+    # New members are checked straight away, members who just came online are moved up
+    # to the hot tier and checked straight away as well
+    scheduled = await scheduler.entries()
+    await scheduler.remove(set(scheduled) - set(members))
+    for entry, member_db in members.items():
+        if entry not in scheduled:
+            await scheduler.schedule(
+                entry, scheduler.classify(member_db.clanmember.last_active, member_online[entry]), now)
+        elif member_online[entry] and scheduled[entry][0] != scheduler.hot_tier:
+            await scheduler.schedule(entry, scheduler.hot_tier, now)
+
+    due = [entry for entry in await scheduler.due(now) if entry in members]
+    await run_sweep(
+        'last-active', due,
+        lambda entry: store_scheduled_last_active(bot, members[entry], entry, member_online[entry]),
+        bot.config.sweep_concurrency)
+
+    depths = ', '.join(
+        f"{tier} {scheduled_count} ({due_count} due)"
+        for tier, (scheduled_count, due_count) in (await scheduler.depths()).items()
+    )
+    log.info(f"Checked last active dates for {len(due)} members, scheduled members per tier: {depths}")
+
+
+async def store_all_profile_last_active(bot):
+    members = []
+    guilds = await bot.database.execute(Guild.select())
+    if not guilds:
+        return
+    for guild in guilds:
+        log.info(f"Finding last active dates for all members of server {guild.guild_id}")
+        members.extend(await bot.database.get_clan_members_by_guild_id(guild.guild_id) or [])
+
+    await run_sweep(
+        'last-active', members, lambda member: store_last_active(bot, member),
+        bot.config.sweep_concurrency)
+
+    log.info("Found last active dates in all guilds")
+
+
+async def store_all_last_active(bot):
+    try:
+        if bot.config.last_active_mode == constants.LAST_ACTIVE_PRESENCE:
+            await store_all_presence_last_active(bot)
+        elif bot.config.last_active_mode == constants.LAST_ACTIVE_SCHEDULED:
+            await store_all_scheduled_last_active(bot)
+        else:
+            await store_all_profile_last_active(bot)
+    finally:
+        # Whatever changed before a sweep was cut short still gets written
+        updated = await bot.last_active_buffer.flush()
+        log.info(f"Updated {updated} last active dates")
+
+
+async def run_activity_sweep(bot, sweep):
+    try:
+        await sweep(bot)
+    except MaintenanceError as e:
+        if not bot.bungie_maintenance:
+            log.info(f"Bungie maintenance is ongoing: {e}")
+            bot.bungie_maintenance = True
+    else:
+        if bot.bungie_maintenance:
+            bot.bungie_maintenance = False
+            log.info("Bungie maintenance has ended")
+
+
+async def iter_archived_summaries(archive, parser, instance_ids, batch_size=1000):
+    loop = asyncio.get_event_loop()
+    for start in range(0, len(instance_ids), batch_size):
+        datas = await loop.run_in_executor(
+            None, lambda: [archive.get_raw(instance_id) for instance_id in instance_ids[start:start + batch_size]])
+        for summary in await parser.parse_many([data for data in datas if data], compressed=True):
+            yield summary
+
+
+async def replay_game(database, summary, tracked_clans, rebuild=False):
+    """Store an archived game for every tracked clan it counts for, returning those clans
+
+    Rebuilding replaces what is stored for those clans and their current members, anything
+    else linked to the game, such as members who have since left, is left alone.
+    """
+    replayed = []
+    game_db = None
+    clan_games = {}
+    for clan_db, member_index, clan_member_ids in tracked_clans:
+        # Clans of a server that aggregates them share an index, and so the same players
+        try:
+            clan_game = clan_games[id(member_index)]
+        except KeyError:
+            clan_game = clan_games[id(member_index)] = ClanGame(summary, member_index)
+        if len(clan_game.clan_players) < constants.MODE_MAP[clan_game.mode_id]['threshold']:
+            continue
+        if not any(player.member_db_id in clan_member_ids for player in clan_game.clan_players):
+            continue
+
+        if game_db is None:
+            try:
+                game_db = await database.create(
+                    Game, mode_id=clan_game.mode_id, instance_id=clan_game.instance_id,
+                    date=clan_game.date, reference_id=clan_game.reference_id)
+            except IntegrityError:
+                if not rebuild:
+                    # Stored since the replay started, along with its clans and members
+                    log.debug(f"Continuing because game {clan_game.instance_id} was stored during the replay")
+                    return replayed
+                game_db = await database.get(Game, instance_id=clan_game.instance_id)
+
+        if rebuild:
+            await database.execute(GameMember.delete().where(
+                (GameMember.game == game_db.id) & (GameMember.member << list(clan_member_ids))))
+        try:
+            await database.get(ClanGameDb, clan=clan_db.id, game=game_db.id)
+        except DoesNotExist:
+            await database.create(ClanGameDb, clan=clan_db.id, game=game_db.id)
+        await database.upsert_game_members(get_game_members(clan_game, game_db))
+        replayed.append(clan_db)
+    return replayed
+
+
+async def replay_pgcr_archive(database, archive, activity_cutoff, rebuild=False, parser=None):
+    parser = parser or PgcrParser()
+    instance_ids = await asyncio.get_event_loop().run_in_executor(None, archive.instance_ids)
+
+    tracked_clans = []
+    for guild_db in await database.execute(Guild.select()):
+        clan_dbs = [
+            clan_db for clan_db in await database.get_clans_by_guild(guild_db.guild_id)
+            if clan_db.activity_tracking
+        ]
+        member_indexes = await get_member_indexes(database, guild_db, clan_dbs)
+        for clan_db in clan_dbs:
+            member_index = member_indexes[clan_db.id]
+            clan_member_ids = set(member.member_id for member in member_index if member.clan_id == clan_db.id)
+            tracked_clans.append((clan_db, member_index, clan_member_ids))
+
+    # Games that already exist were linked to their clans when they were first stored,
+    # so unless rebuilding only missing ones are replayed. Each game is decoded once and
+    # matched against every tracked clan.
+    replay_ids = instance_ids
+    if not rebuild:
+        existing_ids = await database.get_existing_instance_ids(instance_ids)
+        if existing_ids is None:
+            log.error("Could not look up existing games, not replaying the PGCR archive")
+            return 0
+        replay_ids = [instance_id for instance_id in instance_ids if instance_id not in existing_ids]
+    cutoff = max(constants.FORSAKEN_RELEASE, activity_cutoff)
+    supported_modes = set(sum(constants.SUPPORTED_GAME_MODES.values(), []))
+
+    game_count = 0
+    clan_counts = Counter()
+    async for summary in iter_archived_summaries(archive, parser, replay_ids):  # pylint: disable=not-an-iterable
+        if summary.date < cutoff or summary.mode_id not in supported_modes:
+            continue
+        replayed = await replay_game(database, summary, tracked_clans, rebuild)
+        if replayed:
+            game_count += 1
+        clan_counts.update(clan_db.id for clan_db in replayed)
+
+    for clan_db, _, _ in tracked_clans:
+        log.info(f"Replayed {clan_counts[clan_db.id]} games for clan {clan_db.name} from the PGCR archive")
+    log.info(f"Replayed {game_count} games from the PGCR archive")
+    return game_count
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+STATE_OPEN = 'open'
+STATE_CLOSED = 'closed'
+
+# Seconds to wait before subscribing again after losing the subscription, doubling up to the maximum
+LISTEN_RETRY_MIN = 1
+LISTEN_RETRY_MAX = 60
+
+
+class CircuitBreaker(object):
+    """Outage state kept in process, so checking it needs no I/O, and shared between processes over Redis pub/sub"""
+
+    def __init__(self, name, reset_timeout):
+        self.name = name
+        self.key = f"circuit-{name}"
+        self.reset_timeout = reset_timeout
+        self._opened_at = None
+        self._probe = None
+        self._listener = None
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def _open(self):
+        if not self.is_open:
+            log.info(f"Circuit {self.name} opened")
+        self._opened_at = time.monotonic()
+        self._end_probe()
+
+    def _close(self):
+        if self.is_open:
+            log.info(f"Circuit {self.name} closed")
+        self._opened_at = None
+        self._end_probe()
+
+    def _end_probe(self):
+        if self._probe:
+            self._probe.set()
+            self._probe = None
+
+    async def allow(self):
+        while self.is_open:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+
+            # Half open, the first caller gets to probe while everyone else waits to see
+            # how that goes. A probe that never reports back is given up on eventually.
+            if not self._probe:
+                self._probe = asyncio.Event()
+                log.info(f"Circuit {self.name} is half open, probing")
+                return True
+            probe = self._probe
+            try:
+                await asyncio.wait_for(probe.wait(), self.reset_timeout)
+            except asyncio.TimeoutError:
+                if self._probe is probe:
+                    self._probe = None
+        return True
+
+    async def trip(self, redis):
+        self._open()
+        await redis.set(self.key, STATE_OPEN, expire=self.reset_timeout)
+        await redis.publish(self.key, STATE_OPEN)
+
+    async def fail(self, redis):
+        # Outside of a probe a single error says nothing about whether Bungie is down
+        if self._probe:
+            await self.trip(redis)
+
+    def abandon(self):
+        """End a probe that was cancelled before it had an outcome, so the next caller probes instead"""
+        self._end_probe()
+
+    async def reset(self, redis):
+        if not self.is_open:
+            return
+        self._close()
+        await redis.delete(self.key)
+        await redis.publish(self.key, STATE_CLOSED)
+
+    async def _subscribe(self, redis):
+        channel, = await redis.subscribe(self.key)
+        try:
+            # Pick up an outage found while this process wasn't listening
+            if await redis.get(self.key, encoding='utf-8') == STATE_OPEN:
+                self._open()
+            while await channel.wait_message():
+                state = await channel.get(encoding='utf-8')
+                if state == STATE_OPEN:
+                    self._open()
+                elif state == STATE_CLOSED:
+                    self._close()
+        finally:
+            try:
+                await redis.unsubscribe(self.key)
+            except Exception as e:
+                log.debug(f"Circuit {self.name} could not unsubscribe: {e}")
+
+    async def _listen(self, redis):
+        # The subscription ends whenever its connection drops, so keep subscribing again
+        # for as long as the process runs, backing off while Redis can't be reached
+        delay = LISTEN_RETRY_MIN
+        while True:
+            subscribed_at = time.monotonic()
+            try:
+                await self._subscribe(redis)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"Circuit {self.name} lost its subscription: {e}")
+            else:
+                log.warning(f"Circuit {self.name} lost its subscription")
+            if time.monotonic() - subscribed_at > LISTEN_RETRY_MAX:
+                delay = LISTEN_RETRY_MIN
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LISTEN_RETRY_MAX)
+
+    def start(self, redis):
+        if not self._listener or self._listener.done():
+            self._listener = asyncio.ensure_future(self._listen(redis))
+
+    def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
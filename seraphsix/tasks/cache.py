@@ -0,0 +1,76 @@
+import json
+import logging
+import struct
+import time
+import zlib
+
+from collections import Counter, OrderedDict
+from seraphsix.tasks.stats import StatsLog, call_key
+
+log = logging.getLogger(__name__)
+
+# Payloads start with the time they expire, so a copy taken from Redis expires locally
+# at the same time without asking Redis for the key's TTL
+EXPIRES = struct.Struct('<d')
+
+
+class ResponseCache(object):
+    """API responses cached per endpoint for a fixed time, in a local LRU in front of Redis"""
+
+    def __init__(self, name, ttls, max_size=1024, log_every=1000):
+        self.name = name
+        self.ttls = ttls
+        self.max_size = max_size
+        self.hits = Counter()
+        self.misses = Counter()
+        self._entries = OrderedDict()
+        self._stats_log = StatsLog(f"Cache {name}", self.stats, log_every)
+
+    def cacheable(self, endpoint):
+        return endpoint in self.ttls
+
+    def _key(self, endpoint, args):
+        return f"cache-{self.name}-{call_key(endpoint, args)}"
+
+    def _count(self, counter, endpoint):
+        counter[endpoint] += 1
+        self._stats_log.count()
+
+    def stats(self):
+        return {
+            endpoint: dict(hits=self.hits[endpoint], misses=self.misses[endpoint])
+            for endpoint in sorted(set(self.hits) | set(self.misses))
+        }
+
+    def _remember(self, key, payload):
+        self._entries[key] = payload
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, redis, endpoint, args):
+        key = self._key(endpoint, args)
+        now = time.time()
+
+        payload = self._entries.get(key)
+        if payload and EXPIRES.unpack_from(payload)[0] > now:
+            self._entries.move_to_end(key)
+        else:
+            # Another process may have fetched it already
+            payload = await redis.get(key)
+            if not payload or EXPIRES.unpack_from(payload)[0] <= now:
+                self._entries.pop(key, None)
+                self._count(self.misses, endpoint)
+                return None
+            self._remember(key, payload)
+
+        self._count(self.hits, endpoint)
+        return json.loads(zlib.decompress(payload[EXPIRES.size:]))
+
+    async def set(self, redis, endpoint, args, data):
+        key = self._key(endpoint, args)
+        ttl = self.ttls[endpoint]
+        content = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        payload = EXPIRES.pack(time.time() + ttl) + content
+        self._remember(key, payload)
+        await redis.set(key, payload, expire=ttl)
@@ -0,0 +1,36 @@
+import logging
+import os
+import socket
+import uuid
+
+log = logging.getLogger(__name__)
+
+# Deletes the claim in KEYS[1] only if it is still held by the token in ARGV[1], so a
+# claim that expired and was taken by someone else isn't released from under them
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ClaimLock(object):
+    """Claims on a piece of work shared by every process, released or left to expire by the holder"""
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.token = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}"
+
+    def _key(self, item):
+        return f"claim-{self.name}-{item}"
+
+    async def claim(self, redis, item):
+        claimed = await redis.set(self._key(item), self.token, expire=self.ttl, exist=redis.SET_IF_NOT_EXIST)
+        if not claimed:
+            log.debug(f"Claim {self.name} on {item} is held elsewhere")
+        return bool(claimed)
+
+    async def release(self, redis, item):
+        await redis.eval(RELEASE_SCRIPT, keys=[self._key(item)], args=[self.token])
@@ -4,36 +4,26 @@ import logging
 from peewee import DoesNotExist
 from seraphsix import constants
 from seraphsix.database import Member as MemberDb, ClanMember, Clan
-from seraphsix.models.destiny import Member
-from seraphsix.tasks.activity import execute_pydest, store_member_history
+from seraphsix.models.destiny import ClanMemberIndex, Member
+from seraphsix.tasks.activity import execute_pydest
 
 log = logging.getLogger(__name__)
 
 
-async def sort_members(database, member_list):
+def sort_members(member_index, member_list):
     return_list = []
     for member_hash in member_list:
-        clan_id, platform_id, member_id = map(int, member_hash.split('-'))
-
-        member_db = await database.get_member_by_platform(member_id, platform_id)
-        if platform_id == constants.PLATFORM_XBOX:
-            username = member_db.xbox_username
-        elif platform_id == constants.PLATFORM_PSN:
-            username = member_db.psn_username
-        elif platform_id == constants.PLATFORM_BLIZZARD:
-            username = member_db.blizzard_username
-        elif platform_id == constants.PLATFORM_STEAM:
-            username = member_db.steam_username
-        elif platform_id == constants.PLATFORM_STADIA:
-            username = member_db.stadia_username
-
-        return_list.append(username)
+        _, platform_id, member_id = map(int, member_hash.split('-'))
+        member = member_index.get(platform_id, member_id)
+        if member and member.username:
+            return_list.append(member.username)
 
     return sorted(return_list, key=lambda s: s.lower())
 
 
 async def get_all_members(bot, group_id):
-    group = await execute_pydest(bot.destiny.api.get_group_members(group_id), bot.redis)
+    group = await execute_pydest(
+        bot.destiny.api.get_group_members(group_id), bot.redis, priority=constants.PRIORITY_SYNC)
     group_members = group['Response']['results']
     for member in group_members:
         yield Member(member)
@@ -122,39 +112,40 @@ async def member_sync(bot, guild_id):  # noqa
         await bot.database.create(
             ClanMember, clan=clan_db, member=member_db, **member_details)
 
-        clan_member_db = await bot.database.execute(
-            MemberDb.select(MemberDb, ClanMember).join(ClanMember).join(Clan).where(
-                MemberDb.id == member_db.id
-            )
-        )
-
-        # Kick off activity scans for each of the added members
-        # Indexing `clan_member_db` is necessary becuase the query returns a multi-row set, and
-        # normal means of limiting that output (ie. `.get()`) does not work for some reason.
-        member_dbs = await bot.database.get_clan_members([clan_id])
-        asyncio.create_task(store_member_history(member_dbs, bot, clan_member_db[0], count=250))
+        # Queue a full history backfill for each of the added members, they are
+        # worked through by the job consumer at a controlled rate
+        await bot.jobs.enqueue('backfill', member_id=member_db.id, clan_id=clan_id, guild=clan_db.guild_id)
 
         member_changes[clan_db.clan_id]['added'].append(member_hash)
 
-    # Figure out if there are any members to remove
+    # Figure out if there are any members to remove, they are all in the index of members
+    # fetched from the database at the start
+    db_index = ClanMemberIndex(db_members.values())
     members_removed = db_member_set - bungie_member_set
     for member_hash in members_removed:
         clan_id, platform_id, member_id = map(int, member_hash.split('-'))
-        try:
-            member_db = await bot.database.get_member_by_platform(member_id, platform_id)
-        except DoesNotExist:
+        member = db_index.get(platform_id, member_id)
+        if not member:
             log.info(member_id)
             continue
-        clanmember_db = await bot.database.get(ClanMember, member_id=member_db.id)
+        clanmember_db = await bot.database.get(ClanMember, member_id=member.member_id)
         await bot.database.delete(clanmember_db)
         member_changes[clan_db.clan_id]['removed'].append(member_hash)
 
+    # Added members only exist in the database now, removed ones only in the earlier index
+    if members_added:
+        member_index = ClanMemberIndex([
+            *db_members.values(), *await bot.database.get_clan_members(list(member_changes.keys()))
+        ])
+    else:
+        member_index = db_index
+
     for clan, changes in member_changes.items():
         if len(changes['added']):
-            changes['added'] = await sort_members(bot.database, changes['added'])
+            changes['added'] = sort_members(member_index, changes['added'])
             log.info(f"Added members {changes['added']}")
         if len(changes['removed']):
-            changes['removed'] = await sort_members(bot.database, changes['removed'])
+            changes['removed'] = sort_members(member_index, changes['removed'])
             log.info(f"Removed members {changes['removed']}")
 
     return member_changes
@@ -165,7 +156,8 @@ async def info_sync(bot, guild_id):
 
     clan_changes = {}
     for clan_db in clan_dbs:
-        res = await execute_pydest(bot.destiny.api.get_group(clan_db.clan_id), bot.redis)
+        res = await execute_pydest(
+            bot.destiny.api.get_group(clan_db.clan_id), bot.redis, priority=constants.PRIORITY_SYNC)
         group = res['Response']
         bungie_name = group['detail']['name']
         bungie_callsign = group['detail']['clanInfo']['clanCallsign']
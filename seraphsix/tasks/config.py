@@ -3,6 +3,7 @@ import pytz
 
 from dataclasses import dataclass, asdict
 from datetime import datetime
+from seraphsix import constants
 
 
 @dataclass
@@ -29,6 +30,22 @@ class The100Config:
         self.base_url = os.environ.get('THE100_API_URL')
 
 
+@dataclass
+class HttpConfig:
+    connection_limit: int
+    connection_limit_per_host: int
+    dns_cache_ttl: int
+    keepalive_timeout: int
+    request_timeout: int
+
+    def __init__(self):
+        self.connection_limit = int(os.environ.get('HTTP_CONNECTION_LIMIT', 100))
+        self.connection_limit_per_host = int(os.environ.get('HTTP_CONNECTION_LIMIT_PER_HOST', 30))
+        self.dns_cache_ttl = int(os.environ.get('HTTP_DNS_CACHE_TTL', 300))
+        self.keepalive_timeout = int(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', 30))
+        self.request_timeout = int(os.environ.get('HTTP_REQUEST_TIMEOUT', 60))
+
+
 @dataclass
 class TwitterConfig:
     consumer_key: str
@@ -51,6 +68,7 @@ class Config:
     bungie: BungieConfig
     the100: The100Config
     twitter: TwitterConfig
+    http: HttpConfig
     database_url: str
     discord_api_key: str
     redis_url: str
@@ -59,11 +77,18 @@ class Config:
     reg_channel: int
     enable_activity_tracking: bool
     activity_cutoff: str
+    pgcr_archive_path: str
+    pgcr_workers: int
+    manifest_path: str
+    sweep_concurrency: int
+    last_active_mode: str
+    job_concurrency: int
 
     def __init__(self):
         self.bungie = BungieConfig()
         self.the100 = The100Config()
         self.twitter = TwitterConfig()
+        self.http = HttpConfig()
         self.database_url = os.environ.get('DATABASE_URL')
         self.discord_api_key = os.environ.get('DISCORD_API_KEY')
         self.redis_url = os.environ.get('REDIS_URL')
@@ -72,3 +97,9 @@ class Config:
         self.reg_channel = int(os.environ.get('HOME_SERVER_REG_CHANNEL'))
         self.enable_activity_tracking = os.environ.get('ENABLE_ACTIVITY_TRACKING') == 'True'
         self.activity_cutoff = datetime.strptime(os.environ.get('ACTIVITY_CUTOFF'), '%Y-%m-%d').astimezone(tz=pytz.utc)
+        self.pgcr_archive_path = os.environ.get('PGCR_ARCHIVE_PATH')
+        self.pgcr_workers = int(os.environ.get('PGCR_WORKERS', 0))
+        self.manifest_path = os.environ.get('MANIFEST_PATH', 'manifest.db')
+        self.sweep_concurrency = int(os.environ.get('SWEEP_CONCURRENCY', 8))
+        self.last_active_mode = os.environ.get('LAST_ACTIVE_MODE', constants.LAST_ACTIVE_PROFILE)
+        self.job_concurrency = int(os.environ.get('JOB_CONCURRENCY', 2))
@@ -0,0 +1,43 @@
+import asyncio
+import logging
+
+from collections import Counter
+from seraphsix.tasks.stats import StatsLog, call_key
+
+log = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+    """Identical calls made while one is already running wait for that one instead of starting their own"""
+
+    def __init__(self, name, log_every=1000):
+        self.name = name
+        self.shared = Counter()
+        self._calls = {}
+        self._stats_log = StatsLog(f"Single flight {name}", self.stats, log_every)
+
+    def key(self, endpoint, args):
+        return call_key(endpoint, args)
+
+    def stats(self):
+        return dict(self.shared)
+
+    def _done(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Every waiter may have been cancelled, don't complain about an exception nobody saw
+        if not call.cancelled():
+            call.exception()
+
+    async def run(self, endpoint, key, coro, execute):
+        """Run execute(coro) unless the same key is in flight, the result is shared and must not be modified"""
+        call = self._calls.get(key)
+        if call:
+            coro.close()
+            self.shared[endpoint] += 1
+            self._stats_log.count()
+        else:
+            call = self._calls[key] = asyncio.ensure_future(execute(coro))
+            call.add_done_callback(lambda call: self._done(key, call))
+        # A caller giving up shouldn't cancel the call for the others
+        return await asyncio.shield(call)
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class InstanceFilter(object):
+    """Activity instances already dealt with, checked in memory and shared with other processes through Redis
+
+    Entries are scored by when the activity was played, anything played longer ago than
+    the retention period is dropped whenever the local copy is refreshed.
+    """
+
+    def __init__(self, name, retention, refresh):
+        self.name = name
+        self.key = f"instances-{name}"
+        self.retention = retention
+        self.refresh = refresh
+        self._entries = set()
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _member(instance_id, scope):
+        if scope is None:
+            return str(instance_id)
+        return f"{scope}:{instance_id}"
+
+    @staticmethod
+    def _entry(member):
+        scope, _, instance_id = member.rpartition(':')
+        if not scope:
+            return int(instance_id)
+        return (scope, int(instance_id))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def contains(self, instance_id, scope=None):
+        if scope is None:
+            return instance_id in self._entries
+        return (str(scope), instance_id) in self._entries
+
+    async def load(self, redis):
+        async with self._lock:
+            now = time.time()
+            if self._loaded_at and now - self._loaded_at < self.refresh:
+                return
+            removed = await redis.zremrangebyscore(self.key, max=now - self.retention)
+            members = await redis.zrange(self.key, 0, -1, encoding='utf-8')
+            self._entries = {self._entry(member) for member in members}
+            self._loaded_at = now
+        log.info(f"Loaded {len(self)} {self.name} instances, dropped {removed} played before the retention period")
+
+    async def add(self, redis, instances, scope=None):
+        """Add (instance id, date played) pairs"""
+        pairs = []
+        for instance_id, date in instances:
+            self._entries.add(instance_id if scope is None else (str(scope), instance_id))
+            pairs.extend([date.timestamp(), self._member(instance_id, scope)])
+        if pairs:
+            await redis.zadd(self.key, *pairs)
@@ -0,0 +1,236 @@
+import aioredis
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+
+from seraphsix import constants
+from seraphsix.errors import MaintenanceError
+
+log = logging.getLogger(__name__)
+
+# Moves the jobs in the sorted set KEYS[1] that are due by ARGV[1] back onto the stream in
+# KEYS[2], all at once so a job is never lost or requeued twice by consumers racing for it
+RELEASE_SCRIPT = """
+redis.replicate_commands()
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, entry in ipairs(due) do
+    local fields = {}
+    for name, value in pairs(cjson.decode(entry)) do
+        table.insert(fields, name)
+        table.insert(fields, tostring(value))
+    end
+    redis.call('XADD', KEYS[2], '*', unpack(fields))
+    redis.call('ZREM', KEYS[1], entry)
+end
+return #due
+"""
+
+
+class JobCheckpoint(object):
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job = job
+        # Keyed by the message the job was first enqueued as, so duplicate jobs for the same
+        # member never share progress but retries of the same job pick up where it left off
+        self.key = f"{queue.stream}-checkpoint-{job.origin}"
+
+    async def load(self):
+        return await self.queue.redis.hgetall(self.key, encoding='utf-8') or {}
+
+    async def save(self, field, value):
+        await self.queue.redis.hset(self.key, field, value)
+        await self.queue.redis.expire(self.key, constants.JOB_CHECKPOINT_EXPIRE)
+        # Saving progress also shows the job is still alive, so it doesn't get
+        # claimed by another consumer while a long backfill is running
+        await self.queue.touch(self.job)
+
+    async def clear(self):
+        await self.queue.redis.delete(self.key)
+
+
+class Job(object):
+
+    def __init__(self, queue, message_id, fields):
+        self.id = message_id
+        self.type = fields['type']
+        self.key = fields['key']
+        self.payload = json.loads(fields['payload'])
+        self.attempts = int(fields['attempts'])
+        self.origin = fields.get('origin') or message_id.decode('utf-8')
+        self.checkpoint = JobCheckpoint(queue, self)
+
+    def to_fields(self):
+        return dict(
+            type=self.type, key=self.key, payload=json.dumps(self.payload), attempts=self.attempts,
+            origin=self.origin)
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {self.key} ({self.id})>"
+
+
+class JobQueue(object):
+    """Durable job queue on top of a Redis stream and consumer group"""
+
+    def __init__(self, redis, stream=constants.JOB_STREAM, group='workers', max_attempts=5):
+        self.redis = redis
+        self.stream = stream
+        self.group = group
+        self.dead_letter = f"{stream}-dead"
+        self.delayed = f"{stream}-delayed"
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self.max_attempts = max_attempts
+        self._group_created = False
+
+    async def _create_group(self):
+        if self._group_created:
+            return
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, latest_id='0', mkstream=True)
+        except aioredis.errors.ReplyError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_created = True
+
+    def _queued_key(self, key):
+        return f"{self.stream}-queued-{key}"
+
+    async def enqueue(self, job_type, key=None, **payload):
+        await self._create_group()
+        if not key:
+            key = f"{job_type}-{'-'.join(str(value) for _, value in sorted(payload.items()))}"
+
+        # The same job waiting to be picked up already covers this one
+        queued = await self.redis.set(
+            self._queued_key(key), 1, expire=constants.JOB_QUEUED_EXPIRE, exist=self.redis.SET_IF_NOT_EXIST)
+        if not queued:
+            log.debug(f"Skipped job {key}, it is already queued")
+            return None
+
+        fields = dict(type=job_type, key=key, payload=json.dumps(payload), attempts=0)
+        message_id = await self.redis.xadd(self.stream, fields)
+        log.debug(f"Enqueued job {key} ({message_id})")
+        return message_id
+
+    async def _decode(self, messages):
+        jobs = []
+        for _, message_id, fields in messages:
+            try:
+                fields = {key.decode('utf-8'): value.decode('utf-8') for key, value in fields.items()}
+                jobs.append(Job(self, message_id, fields))
+            except (KeyError, TypeError, ValueError) as e:
+                # Reading it again would fail the same way, so set it aside instead
+                log.error(f"Moving malformed job message {message_id} to the dead letter list: {e}")
+                await self.redis.rpush(self.dead_letter, json.dumps(dict(id=str(message_id), fields=str(fields))))
+                await self._done_id(message_id)
+        return jobs
+
+    async def _claim_stale(self, count):
+        # Jobs delivered to a consumer that died before acknowledging them are still
+        # pending, so take them over once they've been idle long enough
+        pending = await self.redis.xpending(self.stream, self.group, '-', '+', count)
+        stale_ids = [
+            message_id for message_id, _, idle, _ in pending
+            if idle >= constants.JOB_VISIBILITY_TIMEOUT * 1000
+        ]
+        if not stale_ids:
+            return []
+        messages = await self.redis.xclaim(
+            self.stream, self.group, self.consumer, constants.JOB_VISIBILITY_TIMEOUT * 1000, *stale_ids)
+        return await self._decode([(self.stream, message_id, fields) for message_id, fields in messages if fields])
+
+    async def touch(self, job):
+        # Claiming a message we already own resets its idle time
+        await self.redis.xclaim(self.stream, self.group, self.consumer, 0, job.id)
+
+    async def _read(self, count):
+        messages = await self.redis.xread_group(
+            self.group, self.consumer, [self.stream], timeout=constants.JOB_POLL_TIMEOUT * 1000,
+            count=count, latest_ids=['>'])
+        return await self._decode(messages)
+
+    async def _retry(self, job, error):
+        job.attempts += 1
+        if job.attempts >= self.max_attempts:
+            log.error(f"Job {job} failed {job.attempts} times, moving it to the dead letter list: {error}")
+            await self.redis.rpush(self.dead_letter, json.dumps(dict(id=job.id.decode('utf-8'), **job.to_fields())))
+            await job.checkpoint.clear()
+        else:
+            # Wait longer after every attempt, so a short outage doesn't use them all up
+            delay = constants.JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            log.info(f"Job {job} failed, retrying in {delay} seconds (attempt {job.attempts}): {error}")
+            await self.redis.zadd(self.delayed, time.time() + delay, json.dumps(job.to_fields()))
+
+    async def _release_delayed(self):
+        released = await self.redis.eval(RELEASE_SCRIPT, keys=[self.delayed, self.stream], args=[time.time()])
+        if released:
+            log.debug(f"Released {released} delayed jobs")
+
+    async def _done_id(self, message_id):
+        # Acknowledged messages are never read again, so drop them from the stream too
+        await self.redis.xack(self.stream, self.group, message_id)
+        await self.redis.xdel(self.stream, message_id)
+
+    async def _done(self, job):
+        await self._done_id(job.id)
+
+    async def _process(self, job, handlers):
+        try:
+            handler = handlers[job.type]
+        except KeyError:
+            await self._retry(job, f"no handler for job type {job.type}")
+            await self._done(job)
+            return
+
+        # Once the job starts, anything new has to be picked up by another one
+        await self.redis.delete(self._queued_key(job.key))
+        try:
+            await handler(job)
+        except MaintenanceError:
+            # Not the job's fault, so put it back without counting it as an attempt
+            await self.redis.xadd(self.stream, job.to_fields())
+            await self._done(job)
+            raise
+        except asyncio.CancelledError:
+            # Shutting down, the job stays pending and is claimed again once it has been
+            # idle for the visibility timeout
+            raise
+        except Exception as e:
+            log.exception(f"Job {job} failed")
+            await self._retry(job, e)
+        else:
+            await job.checkpoint.clear()
+        await self._done(job)
+
+    async def _consume(self, handlers, concurrency):
+        await self._create_group()
+        await self._release_delayed()
+        jobs = await self._claim_stale(concurrency)
+        if not jobs:
+            jobs = await self._read(concurrency)
+        if not jobs:
+            return
+
+        results = await asyncio.gather(
+            *[self._process(job, handlers) for job in jobs], return_exceptions=True)
+        if any(isinstance(result, MaintenanceError) for result in results):
+            log.info("Bungie maintenance is ongoing, pausing job consumption")
+            await asyncio.sleep(constants.TIME_MIN_SECONDS)
+        for job, result in zip(jobs, results):
+            if isinstance(result, Exception) and not isinstance(result, MaintenanceError):
+                log.error(f"Could not finish processing job {job}: {result}")
+
+    async def consume(self, handlers, concurrency=1):
+        log.info(f"Consuming jobs from {self.stream} as {self.consumer} with concurrency {concurrency}")
+        while True:
+            try:
+                await self._consume(handlers, concurrency)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Consumers are only started once, so they must outlive any Redis hiccup
+                log.exception("Could not consume jobs, trying again shortly")
+                await asyncio.sleep(constants.JOB_ERROR_DELAY)
@@ -0,0 +1,92 @@
+import aioredis
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Refills and takes a token from every bucket in KEYS atomically. ARGV holds the
+# current time and the number of tokens the caller has to leave behind in the first
+# bucket, followed by a rate and capacity pair for each bucket. Returns the number of
+# seconds to wait before trying again, or 0 if a token was taken.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local reserve = tonumber(ARGV[2])
+local wait = 0
+local tokens = {}
+local stamps = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local capacity = tonumber(ARGV[i * 2 + 2])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(state[1]) or capacity
+    local stamp = tonumber(state[2]) or now
+    local needed = 1
+    if i == 1 then
+        needed = needed + reserve
+    end
+    available = math.min(capacity, available + math.max(0, now - stamp) * rate)
+    if available < needed then
+        wait = math.max(wait, (needed - available) / rate)
+    end
+    tokens[i] = available
+    stamps[i] = math.max(now, stamp)
+end
+if wait == 0 then
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[i * 2 + 1])
+        local capacity = tonumber(ARGV[i * 2 + 2])
+        redis.call('HMSET', key, 'tokens', tokens[i] - 1, 'ts', stamps[i])
+        redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+    end
+end
+return tostring(wait)
+"""
+
+
+class TokenBucketLimiter(object):
+
+    def __init__(self, name, rate, capacity=None, endpoint_limits=None, reserves=None):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.endpoint_limits = endpoint_limits or {}
+        # Lower priorities have to leave some tokens in the global bucket untouched, so
+        # higher priority callers always find one available. Those lower priorities
+        # only ever consume capacity that isn't otherwise being used.
+        self.reserves = reserves or {}
+        self._sha = None
+
+    def _buckets(self, endpoint):
+        buckets = [(f"ratelimit-{self.name}", self.rate, self.capacity)]
+        if endpoint in self.endpoint_limits:
+            rate, capacity = self.endpoint_limits[endpoint]
+            buckets.append((f"ratelimit-{self.name}-{endpoint}", rate, capacity))
+        return buckets
+
+    async def _take(self, redis, keys, args):
+        if not self._sha:
+            self._sha = await redis.script_load(TOKEN_BUCKET_SCRIPT)
+        try:
+            return await redis.evalsha(self._sha, keys=keys, args=args)
+        except aioredis.errors.ReplyError as e:
+            # Redis was restarted or flushed its script cache
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+            self._sha = await redis.script_load(TOKEN_BUCKET_SCRIPT)
+            return await redis.evalsha(self._sha, keys=keys, args=args)
+
+    async def acquire(self, redis, endpoint=None, priority=None):
+        reserve = self.reserves.get(priority, 0)
+        keys = []
+        limits = []
+        for key, rate, capacity in self._buckets(endpoint):
+            keys.append(key)
+            limits.extend([rate, capacity])
+
+        while True:
+            wait = float(await self._take(redis, keys, [time.time(), reserve, *limits]))
+            if not wait:
+                return
+            log.debug(f"Waiting {wait:0.3f} seconds for a {self.name} token for {endpoint} at priority {priority}")
+            await asyncio.sleep(wait)
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import math
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from seraphsix.models.destiny import parse_pgcr, parse_pgcr_response
+
+log = logging.getLogger(__name__)
+
+
+class PgcrParser(object):
+    """Decodes batches of raw PGCRs into summaries, in worker processes if configured so the loop only does I/O"""
+
+    def __init__(self, workers=0, chunk_size=64):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._executor = None
+        if workers:
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+            log.info(f"Parsing PGCRs in {workers} worker processes")
+
+    async def _map(self, parse, datas):
+        datas = list(datas)
+        if not self._executor or not datas:
+            return [parse(data) for data in datas]
+        # Sending a single report to a worker costs more than decoding it here, so each
+        # batch is split into as few chunks as keeps every worker busy. The map itself
+        # blocks, so it waits in a thread.
+        chunk_size = min(self.chunk_size, math.ceil(len(datas) / self.workers))
+        return await asyncio.get_event_loop().run_in_executor(
+            None, lambda: list(self._executor.map(parse, datas, chunksize=chunk_size)))
+
+    async def parse_many(self, datas, compressed=False):
+        """Summaries of PGCRs as archived"""
+        return await self._map(partial(parse_pgcr, compressed=compressed), datas)
+
+    async def parse_responses(self, datas, archive=False):
+        """(summary, error, compressed PGCR) of each PGCR API response"""
+        return await self._map(partial(parse_pgcr_response, archive=archive), datas)
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
@@ -0,0 +1,75 @@
+import logging
+import pytz
+import time
+
+from datetime import datetime
+from seraphsix import constants
+
+log = logging.getLogger(__name__)
+
+
+class ActivityScheduler(object):
+    """Per member activity checks, spread over tiers polled at different intervals depending on recency"""
+
+    def __init__(self, redis, tiers=constants.ACTIVITY_TIERS, prefix='schedule'):
+        self.redis = redis
+        self.tiers = tiers
+        self.prefix = prefix
+        self.intervals = {tier: interval for tier, _, interval in tiers}
+
+    def _key(self, tier):
+        return f"{self.prefix}-{tier}"
+
+    @property
+    def hot_tier(self):
+        return self.tiers[0][0]
+
+    def classify(self, last_active, is_online=False):
+        if is_online:
+            return self.hot_tier
+        if last_active:
+            idle = (datetime.now(pytz.utc) - last_active).total_seconds()
+            for tier, played_within, _ in self.tiers:
+                if played_within and idle <= played_within:
+                    return tier
+        return self.tiers[-1][0]
+
+    async def entries(self):
+        scheduled = {}
+        for tier, _, _ in self.tiers:
+            for entry, due in await self.redis.zrange(self._key(tier), 0, -1, withscores=True, encoding='utf-8'):
+                scheduled[entry] = (tier, due)
+        return scheduled
+
+    async def schedule(self, entry, tier, due=None):
+        # An entry only ever lives in one tier
+        if due is None:
+            due = time.time() + self.intervals[tier]
+        for other_tier, _, _ in self.tiers:
+            if other_tier != tier:
+                await self.redis.zrem(self._key(other_tier), entry)
+        await self.redis.zadd(self._key(tier), due, entry)
+
+    async def remove(self, entries):
+        if not entries:
+            return
+        for tier, _, _ in self.tiers:
+            await self.redis.zrem(self._key(tier), *entries)
+
+    async def due(self, now=None):
+        if now is None:
+            now = time.time()
+        entries = []
+        for tier, _, _ in self.tiers:
+            entries.extend(await self.redis.zrangebyscore(self._key(tier), max=now, encoding='utf-8'))
+        return entries
+
+    async def depths(self, now=None):
+        """Number of members scheduled in each tier, and how many of those are due"""
+        if now is None:
+            now = time.time()
+        depths = {}
+        for tier, _, _ in self.tiers:
+            key = self._key(tier)
+            depths[tier] = (await self.redis.zcard(key), await self.redis.zcount(key, max=now))
+        return depths
@@ -0,0 +1,24 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def call_key(endpoint, args):
+    """An API call and its arguments as a stable string, leaving out self"""
+    values = ':'.join(f"{name}={value}" for name, value in sorted(args.items()) if name != 'self')
+    return f"{endpoint}-{values}"
+
+
+class StatsLog(object):
+    """Logs a component's stats every so many of the events it counts"""
+
+    def __init__(self, label, stats, every=1000):
+        self.label = label
+        self.stats = stats
+        self.every = every
+        self.events = 0
+
+    def count(self):
+        self.events += 1
+        if self.events % self.every == 0:
+            log.info(f"{self.label} stats: {self.stats()}")
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import time
+
+from seraphsix.errors import MaintenanceError
+
+log = logging.getLogger(__name__)
+
+
+async def run_sweep(name, items, worker, concurrency, progress_every=100):
+    """Run `worker` over `items` with at most `concurrency` of them in flight at once"""
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    total = queue.qsize()
+    if not total:
+        return []
+
+    results = []
+    latencies = []
+    started = time.monotonic()
+
+    async def consume():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            item_started = time.monotonic()
+            try:
+                results.append(await worker(item))
+            except MaintenanceError:
+                raise
+            except Exception:
+                log.exception(f"Sweep {name} failed to process {item}")
+            finally:
+                latencies.append(time.monotonic() - item_started)
+
+            if len(latencies) % progress_every == 0:
+                log.info(f"Sweep {name} processed {len(latencies)}/{total} items")
+
+    workers = [asyncio.create_task(consume()) for _ in range(min(concurrency, total))]
+    try:
+        await asyncio.gather(*workers)
+    except MaintenanceError:
+        # No point in continuing the sweep, everything else will fail as well
+        for task in workers:
+            task.cancel()
+        raise
+
+    latencies.sort()
+    log.info(
+        f"Sweep {name} processed {total} items in {time.monotonic() - started:0.1f}s "
+        f"with {len(workers)} workers, latency avg {sum(latencies) / total:0.3f}s "
+        f"p95 {latencies[min(total - 1, int(total * 0.95))]:0.3f}s max {latencies[-1]:0.3f}s"
+    )
+    return results
@@ -0,0 +1,103 @@
+import aiohttp
+import logging
+
+from collections import Counter
+from seraphsix.tasks.stats import StatsLog
+
+log = logging.getLogger(__name__)
+
+
+class HttpMetrics(object):
+    """Counts requests and whether they got a new or a reused connection"""
+
+    def __init__(self, log_every=1000):
+        self.counts = Counter()
+        self._stats_log = StatsLog("HTTP", self.stats, log_every)
+
+    def trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_exception.append(self._counter('request_errors'))
+        trace_config.on_connection_create_end.append(self._counter('connections_created'))
+        trace_config.on_connection_reuseconn.append(self._counter('connections_reused'))
+        trace_config.on_dns_cache_hit.append(self._counter('dns_cache_hits'))
+        trace_config.on_dns_cache_miss.append(self._counter('dns_cache_misses'))
+        return trace_config
+
+    def _counter(self, name):
+        async def count(session, context, params):
+            self.counts[name] += 1
+        return count
+
+    async def _on_request_start(self, session, context, params):
+        self.counts['requests'] += 1
+        self._stats_log.count()
+
+    def stats(self):
+        stats = dict(self.counts)
+        connections = self.counts['connections_created'] + self.counts['connections_reused']
+        if connections:
+            stats['reuse_ratio'] = round(self.counts['connections_reused'] / connections, 3)
+        return stats
+
+
+class HttpTransport(object):
+    """A single pooled HTTP session shared by every API client"""
+
+    def __init__(self, config):
+        self.config = config
+        self.metrics = HttpMetrics()
+        self.session = None
+        self._attached = set()
+
+    def connect(self):
+        if self.session and not self.session.closed:
+            return self.session
+        connector = aiohttp.TCPConnector(
+            limit=self.config.connection_limit,
+            limit_per_host=self.config.connection_limit_per_host,
+            ttl_dns_cache=self.config.dns_cache_ttl,
+            keepalive_timeout=self.config.keepalive_timeout
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'Accept-Encoding': 'gzip, deflate'},
+            timeout=aiohttp.ClientTimeout(total=self.config.request_timeout),
+            trace_configs=[self.metrics.trace_config()]
+        )
+        return self.session
+
+    async def attach(self, client, *attributes):
+        """Swap the sessions a client created for itself with the shared one, all of them or none"""
+        session = self.connect()
+        targets = []
+        for attribute in attributes:
+            target = client
+            *path, name = attribute.split('.')
+            for part in path:
+                target = getattr(target, part, None)
+            if target is None or not hasattr(target, name):
+                log.warning(f"{type(client).__name__} has no {attribute}, it keeps its own connections")
+                return False
+            targets.append((target, name))
+
+        own_sessions = []
+        for target, name in targets:
+            own_session = getattr(target, name)
+            if own_session is not None and own_session is not session and own_session not in own_sessions:
+                own_sessions.append(own_session)
+            setattr(target, name, session)
+        for own_session in own_sessions:
+            if not own_session.closed:
+                await own_session.close()
+        self._attached.add(id(client))
+        return True
+
+    async def close(self, *clients):
+        """Close the shared session, and any of the clients that kept their own"""
+        for client in clients:
+            if id(client) not in self._attached:
+                await client.close()
+        if self.session:
+            log.info(f"HTTP stats: {self.metrics.stats()}")
+            await self.session.close()
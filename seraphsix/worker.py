@@ -0,0 +1,39 @@
+import asyncio
+import logging
+import time
+
+from seraphsix import constants
+from seraphsix.pipeline import ActivityPipeline
+from seraphsix.tasks.activity import get_job_handlers, run_activity_sweep, store_all_guild_games, store_all_last_active
+
+log = logging.getLogger(__name__)
+
+
+class IngestWorker(ActivityPipeline):
+    """Runs the activity tracking pipelines on their own, without connecting to Discord"""
+
+    def __init__(self, config):
+        self.setup_pipeline(config)
+
+    async def run_every(self, seconds, sweep, delay=0):
+        await asyncio.sleep(delay)
+        while True:
+            started = time.monotonic()
+            try:
+                await run_activity_sweep(self, sweep)
+            except Exception:
+                log.exception(f"Sweep {sweep.__name__} failed")
+            await asyncio.sleep(max(0, seconds - (time.monotonic() - started)))
+
+    async def run(self):
+        await self.connect_redis()
+        await self.attach_transport()
+        log.info("Starting activity ingestion")
+        await asyncio.gather(
+            self.run_every(5 * constants.TIME_MIN_SECONDS, store_all_last_active),
+            self.run_every(constants.TIME_HOUR_SECONDS, store_all_guild_games, delay=constants.TIME_MIN_SECONDS),
+            self.jobs.consume(get_job_handlers(self), self.config.job_concurrency)
+        )
+
+    async def close(self):
+        await self.close_pipeline()